@@ -1,7 +1,5 @@
 import json
 import sys
-import os
-import time
 import random
 
 sys.path.append('/Users/kusha/qas')
@@ -23,22 +21,7 @@ for question in data['questions']:
 
 random.shuffle(pairs)
 
-success = 0
-processed = 0
 with QASystem(db_filename="knowledge.db") as qa_system:
-    for question, answer in pairs:
-        print("suppress output")
-        # sys.stdout = os.devnull
-        # sys.stderr = os.devnull
-        start_time = time.time()
-        result = qa_system.extend(question, answer)
-        end_time = time.time()
-        spent_time = end_time - start_time
-        # sys.stdout = sys.__stdout__
-        # sys.stderr = sys.__stderr__
-        # print("back")
-        print(result)
-        if result:
-            success += 1
-        processed += 1
-        print("RECORD", spent_time, success, processed, len(pairs))
\ No newline at end of file
+    stats = qa_system.extend_many(pairs)
+    print("RECORD", stats['elapsed'], stats['learned'], stats['processed'],
+          len(pairs))
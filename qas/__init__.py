@@ -1,9 +1,4 @@
 #!/usr/bin/env python3
 
-import gevent.monkey
-gevent.monkey.patch_ssl()
-# gevent monkey patch before importing requests
-# detailed info:
-# https://github.com/kennethreitz/requests/issues/3752
-# __init__.py is possible place to put monkey_patch call
-# until the bug is not fixed in the current requests version
+# gevent monkey patch before importing requests is applied lazily
+# (qas.lazy.patch_ssl), heavy modules are imported on the first use
@@ -3,7 +3,7 @@
 import sys
 import argparse
 
-from qas.core import QASystem
+import qas.lazy
 
 
 class InvalidArguments(Exception):
@@ -48,6 +48,15 @@ def main():
         action="store",
         default="config.ini",
         help="configuration file")
+    parser.add_argument(
+        "--startup-times",
+        action="store_true",
+        help="print load time of the system components")
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="load all system components concurrently before the action"
+             " (only needed ones are loaded by default)")
     # parser.add_argument(
     #     "--disable-wikidata",
     #     action="store_true",
@@ -77,7 +86,14 @@ def main():
 
     # print(action)
 
+    # heavy modules are imported only for a valid action
+    with qas.lazy.timed('qas'):
+        from qas.core import QASystem
     qa_system = QASystem.process_args(args)
+    # components are loaded lazily by default, the warm-up loads all
+    # of them concurrently (the action waits only for the needed ones)
+    if args.warm_up:
+        qa_system.warm_up()
 
     # perform action
     if action == "answer":
@@ -89,6 +105,16 @@ def main():
         result = qa_system.extend(question, answer)
         print(result)
 
+    if args.startup_times:
+        print_startup_times()
+
+
+def print_startup_times():
+    print("Seconds\t| Component")
+    print("-" * 20)
+    for name, seconds in qas.lazy.TIMINGS.items():
+        print("{:.3f}\t| {}".format(seconds, name))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,207 @@
+"""
+Bloom filter over prefixes of normalized labels.
+
+Searches (wbsearchentities and the label index) match labels by
+prefix, so the filter keeps short character prefixes and all prefixes
+ending at a word boundary of every label. Permutations, which fail
+either check, can't be a prefix of any label and are dropped before
+the search requests.
+
+Usage:
+python3 -m qas.bloom index labels.filter
+"""
+
+import hashlib
+import math
+import mmap
+import struct
+import sys
+
+from qas.label_index import normalize_label
+
+MAGIC = b'QASP'  # prefixes filter (full labels filters are not valid)
+HEADER = struct.Struct('=4sQI')
+ERROR_RATE = 0.01
+PREFIX_LENGTH = 8  # character prefixes of labels kept in the filter
+
+
+class InvalidFilter(Exception):
+    pass
+
+
+def label_prefixes(text):
+    """
+    Prefixes of the label added to the filter: character prefixes up
+    to PREFIX_LENGTH and prefixes ending at a word boundary.
+
+    >>> sorted(label_prefixes("New York City"))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['n', 'ne', 'new', 'new y', 'new yo', 'new yor', 'new york',
+     'new york city']
+    """
+    label = normalize_label(text)
+    prefixes = set(label[:length].rstrip()
+                   for length in range(1, min(len(label), PREFIX_LENGTH) + 1))
+    words = label.split(" ")
+    prefixes.update(" ".join(words[:count])
+                    for count in range(1, len(words) + 1))
+    return prefixes
+
+
+def query_prefixes(text):
+    """
+    Prefixes of the searched text, which are prefixes of any label
+    matching the text.
+
+    >>> query_prefixes("New York City Hall")
+    ['new york', 'new york city']
+    """
+    query = normalize_label(text)
+    words = query.split(" ")
+    prefixes = [query[:PREFIX_LENGTH].rstrip()]
+    if len(words) > 1:
+        prefixes.append(" ".join(words[:-1]))
+    return prefixes
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of labels prefixes.
+
+    >>> bloom_filter = BloomFilter.for_capacity(100)
+    >>> bloom_filter.add("New York City")
+    >>> [text in bloom_filter
+    ...  for text in ["new york", "New Yo", "new york city", "new"]]
+    [True, True, True, True]
+    >>> [text in bloom_filter for text in ["york", "city", "oslo", ""]]
+    [False, False, False, False]
+
+    Attributes:
+        size (int): number of bits.
+        hashes (int): number of hash functions.
+    """
+    def __init__(self, size, hashes, data=None, mapping=None):
+        self.size = size
+        self.hashes = hashes
+        if data is None:
+            data = bytearray((size + 7) // 8)
+        self.data = data
+        # memory-mapped file (updated in place) or None
+        self.mapping = mapping
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=ERROR_RATE):
+        """
+        Create empty filter with the given false positives rate.
+
+        Args:
+            capacity (int): expected number of labels.
+            error_rate (float): false positives probability.
+        """
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) /
+                             (math.log(2) ** 2)))
+        hashes = max(int(round(size / float(capacity) * math.log(2))), 1)
+        return cls(size, hashes)
+
+    def positions(self, text):
+        # double hashing with two halves of a single digest
+        digest = hashlib.blake2b(normalize_label(text).encode('utf-8'),
+                                 digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + idx * second) % self.size
+                for idx in range(self.hashes)]
+
+    def add_key(self, key):
+        for position in self.positions(key):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def has_key(self, key):
+        for position in self.positions(key):
+            if not self.data[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, text):
+        """
+        Add label (its prefixes).
+        """
+        for prefix in label_prefixes(text):
+            self.add_key(prefix)
+
+    def __contains__(self, text):
+        """
+        Text can be a prefix of any added label.
+        """
+        return all(self.has_key(prefix) for prefix in query_prefixes(text))
+
+    def add_search_results(self, results):
+        """
+        Learn labels and aliases from wbsearchentities results.
+        """
+        for result in results:
+            if 'label' in result:
+                self.add(result['label'])
+            for alias in result.get('aliases', []):
+                self.add(alias)
+            if 'match' in result:
+                self.add(result['match']['text'])
+
+    def save(self, filename):
+        with open(filename, 'wb') as filter_file:
+            filter_file.write(HEADER.pack(MAGIC, self.size, self.hashes))
+            filter_file.write(self.data)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the filter via mmap, learned labels are written
+        to the file.
+        """
+        with open(filename, 'r+b') as filter_file:
+            mapping = mmap.mmap(filter_file.fileno(), 0,
+                                access=mmap.ACCESS_WRITE)
+        magic, size, hashes = HEADER.unpack_from(mapping, 0)
+        if magic != MAGIC:
+            mapping.close()
+            raise InvalidFilter(filename)
+        return cls(size, hashes,
+                   data=memoryview(mapping)[HEADER.size:],
+                   mapping=mapping)
+
+    def close(self):
+        if self.mapping is not None:
+            self.data.release()
+            self.mapping.flush()
+            self.mapping.close()
+            self.mapping = None
+
+
+def from_label_index(prefix, error_rate=ERROR_RATE):
+    """
+    Build the filter from labels and aliases of the offline index.
+
+    Args:
+        prefix (str): label index files prefix.
+        error_rate (float): false positives probability.
+    """
+    from qas.sstable import Table
+    labels = Table(prefix + '.labels')
+    capacity = sum(len(label_prefixes(labels.key(row).decode('utf-8')))
+                   for row in range(len(labels)))
+    bloom_filter = BloomFilter.for_capacity(capacity, error_rate)
+    for row in range(len(labels)):
+        bloom_filter.add(labels.key(row).decode('utf-8'))
+    labels.close()
+    return bloom_filter
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.exit("Usage: python3 -m qas.bloom INDEX_PREFIX FILTER_FILENAME")
+    from_label_index(sys.argv[1]).save(sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
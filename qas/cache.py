@@ -0,0 +1,172 @@
+"""
+Persistent caches of the processing results.
+"""
+
+import collections
+import hashlib
+import os
+import pickle
+import unicodedata
+
+SENTENCE_CACHE_SIZE = 1000
+COMPACT_FACTOR = 2  # cache file records per cached sentence
+
+
+def normalize_text(text):
+    """
+    Normalize sentence text for the cache lookup.
+
+    >>> normalize_text(" In what  city is\\tthe Heineken brewery? ")
+    'In what city is the Heineken brewery?'
+
+    Args:
+        text (str): sentence.
+
+    Returns:
+        str: text with unified unicode form and whitespaces.
+    """
+    text = unicodedata.normalize('NFC', text)
+    return " ".join(text.split())
+
+
+class SentenceCache(object):
+    """
+    Size bounded (LRU) cache of processed sentences.
+
+    Stored values are serializable entities sets (EntitySet.dump).
+    Updates are appended to the file (fingerprint followed by
+    (key, value) records), the file is compacted when it grows over
+    COMPACT_FACTOR times the cache size. Entries created with different
+    linking settings (fingerprint) are dropped on load.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'sentences.cache')
+    >>> cache = SentenceCache(filename, size=2, fingerprint=("en", ))
+    >>> for text in ["First?", "Second?", "First?", "Third?"]:
+    ...     cache.put(text, [text])
+    >>> list(SentenceCache(filename, size=2, fingerprint=("en", )).entries)
+    ['First?', 'Third?']
+    >>> len(SentenceCache(filename, size=2, fingerprint=("cs", )))
+    0
+    """
+    def __init__(self, filename=None, size=SENTENCE_CACHE_SIZE,
+                 fingerprint=None):
+        self.filename = filename
+        self.size = size
+        self.fingerprint = fingerprint
+        self.entries = collections.OrderedDict()
+        # records in the file, None if the file has to be rewritten
+        self.records = None
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as cache_file:
+                if pickle.load(cache_file) != self.fingerprint:
+                    return
+                self.records = 0
+                size = os.fstat(cache_file.fileno()).st_size
+                while cache_file.tell() < size:
+                    key, value = pickle.load(cache_file)
+                    self.entries[key] = value
+                    self.entries.move_to_end(key)
+                    self.records += 1
+        except (OSError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            # record cut by an interruption, the file is rewritten
+            self.records = None
+        self.shrink()
+
+    def save(self):
+        if self.filename is None:
+            return
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'wb') as cache_file:
+            pickle.dump(self.fingerprint, cache_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            for item in self.entries.items():
+                pickle.dump(item, cache_file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.filename)
+        self.records = len(self.entries)
+
+    def append(self, key, value):
+        if self.filename is None:
+            return
+        if self.records is None or \
+           self.records >= COMPACT_FACTOR * max(self.size, 1):
+            self.save()
+            return
+        with open(self.filename, 'ab') as cache_file:
+            pickle.dump((key, value, ), cache_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        self.records += 1
+
+    def shrink(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, text):
+        key = normalize_text(text)
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, text, value):
+        key = normalize_text(text)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.shrink()
+        self.append(key, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Checkpoint(object):
+    """
+    Processed keys of a bulk job (e.g. learned question-answer pairs).
+
+    Keys are appended to the file after every batch, so an interrupted
+    job continues with the rest of the inputs.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'extend.checkpoint')
+    >>> checkpoint = Checkpoint(filename)
+    >>> checkpoint.add([Checkpoint.key("Who is  here?", "Me")])
+    >>> Checkpoint.key("Who is here?", "Me") in Checkpoint(filename)
+    True
+    >>> Checkpoint.key("Who is here?", "You") in Checkpoint(filename)
+    False
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.done = set()
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as checkpoint_file:
+                self.done = set(line.strip() for line in checkpoint_file
+                                if line.strip())
+
+    @staticmethod
+    def key(*texts):
+        data = "\x1f".join(normalize_text(text) for text in texts)
+        return hashlib.blake2b(data.encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, keys):
+        keys = [key for key in keys if key not in self.done]
+        self.done.update(keys)
+        if self.filename is None or len(keys) == 0:
+            return
+        with open(self.filename, 'a') as checkpoint_file:
+            checkpoint_file.write("".join(key + "\n" for key in keys))
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
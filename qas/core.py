@@ -2,21 +2,106 @@
 Main module with QA system implementation.
 """
 
-import shelve
-import spacy
 import time
-import itertools
 import configparser
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
 import operator
+import threading
 
-from nltk import word_tokenize
-from nltk.tokenize import sent_tokenize
-import langdetect
-
+import qas.lazy
 import qas.logs
 import qas.graph
 import qas.sentence
+import qas.noun_phrase
 import qas.items
+import qas.wikidata
+import qas.cache
+import qas.synonyms
+import qas.bloom
+import qas.structural_index
+import qas.vector_index
+import qas.template_index
+import qas.store
+import qas.label_index
+import qas.fuzzy_index
+
+
+EXTEND_BATCH_SIZE = 50
+# langdetect loads its profiles on the first detection, not thread-safe
+LANGUAGE_PROFILES_LOCK = threading.Lock()
+# graph search state of an extension worker process
+EXTEND_WORKER = {}
+
+
+def init_extend_worker(sparql_cache, budget_limits):
+    """
+    Initialize an extension worker process.
+
+    Args:
+        sparql_cache (dict): SPARQL responses cache shared by workers.
+        budget_limits (tuple): time, queries and rows search limits.
+    """
+    qas.wikidata.use_sparql_cache(sparql_cache)
+    EXTEND_WORKER['budget_limits'] = budget_limits
+
+
+def extend_worker(task):
+    """
+    Graph search of a single question-answer pair.
+
+    Args:
+        task (tuple): pair position, question and answer entities
+            (qas.items.ItemsEntity.dump of each entity).
+
+    Returns:
+        tuple: pair position, the best solutions as (score, path,
+            config, item from id) tuples (the best last) or None,
+            types of the question items (item id -> type ids) and
+            whether the search was interrupted (no solutions because
+            of the budget or failed queries).
+    """
+    position, question_entities, answer_entities = task
+    labeled_entities = \
+        [("question", qas.items.ItemsEntity(raw))
+         for raw in question_entities] + \
+        [("answer", qas.items.ItemsEntity(raw))
+         for raw in answer_entities]
+    graph_ = qas.graph.Graph(labeled_entities)
+    budget = qas.graph.SearchBudget(*EXTEND_WORKER['budget_limits'])
+    solutions = graph_.connect("question", "answer", budget=budget)
+    if len(solutions) == 0:
+        return position, None, {}, budget.interrupted
+    solutions = qas.graph.Graph.evaluate_solutions(solutions)
+    # types are fetched by workers, not by the saving process
+    item_ids = qas.items.unique_items(item_id
+                                      for raw in question_entities
+                                      for item_id, _, _ in raw)
+    try:
+        types = qas.wikidata.Wikidata.get_types(
+            item_ids, timeout=budget.query_timeout())
+    except (qas.wikidata.NoSPARQLResponse,
+            OSError, ValueError, KeyError):
+        types = {}
+    return position, [(score,
+                       solution.path,
+                       list(solution.config),
+                       None if solution.item_from is None
+                       else solution.item_from.wd_item_id, )
+                      for score, solution in solutions[-10:]], \
+        types, False
+
+
+def load_language_profiles():
+    """
+    Load langdetect profiles once. langdetect sets its factory before
+    the profiles are loaded, so concurrent first detections (warm-up
+    thread and the first question) are serialized.
+    """
+    with LANGUAGE_PROFILES_LOCK:
+        qas.lazy.langdetect.detector_factory.init_factory()
 
 
 class InvalidSentence(Exception):
@@ -72,20 +157,220 @@ class QASystem(qas.logs.LoggingService):
 
         # database initialization
         self.log.debug('Loading database...')
-        self.db = shelve.open(self.settings['DEFAULT']['db_filename'],
-                              flag="c")
-        # prefill database if newly initialized
-        if 'knowledge' in self.db:
-            self.log.info('Database loaded')
-        else:
-            self.log.info('Creating new database')
-            self.db['knowledge'] = []
-        self.log.info('%s known questions', len(self.db['knowledge']))
+        with qas.lazy.timed('store'):
+            self.store = qas.store.KnowledgeStore(
+                self.settings['DEFAULT']['store_filename'])
+            # migrate knowledge of the old shelve database
+            if len(self.store) == 0:
+                qas.store.migrate_shelve(
+                    self.settings['DEFAULT']['db_filename'],
+                    self.store,
+                    log=self.log)
+        self.log.info('%s known questions', len(self.store))
+
+        # offline entities linking (optional)
+        label_index = self.settings['DEFAULT'].get('label_index', '').strip()
+        if not label_index and self.settings['DEFAULT'].getboolean(
+                'fuzzy_linking', fallback=False):
+            self.log.warning('Fuzzy linking needs the label index '
+                             '(label_index option), using the search API.')
+        if label_index:
+            self.log.debug('Loading label index %s', label_index)
+            with qas.lazy.timed('label_index'):
+                if self.settings['DEFAULT'].getboolean('fuzzy_linking',
+                                                       fallback=False):
+                    qas.items.use_label_index(
+                        qas.fuzzy_index.FuzzyIndex(label_index), fuzzy=True)
+                else:
+                    qas.items.use_label_index(
+                        qas.label_index.LabelIndex(label_index))
+
+        # known labels filter (optional)
+        label_filter = \
+            self.settings['DEFAULT'].get('label_filter', '').strip()
+        if label_filter:
+            self.log.debug('Loading label filter %s', label_filter)
+            with qas.lazy.timed('label_filter'):
+                qas.items.use_label_filter(
+                    qas.bloom.BloomFilter.load(label_filter))
+
+        # precomputed WordNet synonyms (optional)
+        synonym_table = \
+            self.settings['DEFAULT'].get('synonym_table', '').strip()
+        if synonym_table:
+            self.log.debug('Loading synonyms table %s', synonym_table)
+            with qas.lazy.timed('synonym_table'):
+                qas.noun_phrase.use_synonym_table(
+                    qas.synonyms.SynonymTable(synonym_table))
+
+        # processed sentences cache
+        with qas.lazy.timed('sentence_cache'):
+            self.sentence_cache = self.create_sentence_cache()
+
+        # spaCy model and indexes of stored questions
+        # are loaded on the first use
+        self._nlp = None
+        self._structural_index = None
+        self._vector_index = None
+        self._vector_index_created = False
+        self._template_index = None
+        # components may be loaded by warm-up threads
+        self._locks = {name: threading.Lock()
+                       for name in ["nlp",
+                                    "structural_index",
+                                    "vector_index",
+                                    "template_index"]}
+        self.ready = threading.Event()
+        self.warming_up = False
+
+    @property
+    def nlp(self):
+        """
+        spaCy model (loaded on the first use).
+        """
+        if self._nlp is None:
+            with self._locks['nlp']:
+                if self._nlp is None:
+                    self.log.debug('Loading spaCy NLP')
+                    with qas.lazy.timed('spacy_model'):
+                        self._nlp = qas.lazy.spacy.load(
+                            self.settings['DEFAULT']['spacy_model'])
+                    self.log.debug('spaCy loaded')
+        return self._nlp
+
+    @property
+    def structural_index(self):
+        """
+        Structural index of stored questions (loaded on the first use).
+        """
+        if self._structural_index is None:
+            with self._locks['structural_index']:
+                if self._structural_index is None:
+                    with qas.lazy.timed('structural_index'):
+                        self._structural_index = self.load_structural_index()
+        return self._structural_index
+
+    @property
+    def vector_index(self):
+        """
+        Vectors of stored questions (loaded on the first use).
+        """
+        if not self._vector_index_created:
+            with self._locks['vector_index']:
+                if not self._vector_index_created:
+                    with qas.lazy.timed('vector_index'):
+                        self._vector_index = self.create_vector_index()
+                    self._vector_index_created = True
+        return self._vector_index
+
+    @property
+    def template_index(self):
+        """
+        Masked templates of stored questions (loaded on the first use).
+        """
+        if self._template_index is None:
+            with self._locks['template_index']:
+                if self._template_index is None:
+                    with qas.lazy.timed('template_index'):
+                        self._template_index = \
+                            qas.template_index.TemplateIndex(
+                                dict(self.store.templates()))
+        return self._template_index
+
+    def load_structural_index(self):
+        if self.store.has_links() or len(self.store) == 0:
+            return qas.structural_index.StructuralIndex.from_links(
+                self.store.links())
+        return self.build_structural_index()
+
+    def warm_up(self):
+        """
+        Load the system components concurrently in background threads:
+        spaCy model (and vectors of stored questions), synonyms
+        (WordNet corpus or the table), langdetect profiles and indexes
+        of the knowledge store. .ready is set when all of them are
+        loaded (see wait_ready).
 
-        # spaCy initialization
-        self.log.debug('Loading spaCy NLP')
-        self.nlp = spacy.load(self.settings['DEFAULT']['spacy_model'])
-        self.log.debug('spaCy loaded')
+        Returns:
+            threading.Event: readiness signal.
+        """
+        if self.warming_up or self.ready.is_set():
+            return self.ready
+        self.warming_up = True
+
+        def spacy_model():
+            self.nlp("warm up")
+            self.vector_index  # pylint: disable=pointless-statement
+
+        def synonyms():
+            if self.settings['DEFAULT'].getboolean('disable_wordnet',
+                                                   fallback=False):
+                return
+            with qas.lazy.timed('synonyms'):
+                qas.noun_phrase.get_synonyms("question")
+
+        def language_profiles():
+            qas.lazy.nltk_tokenize.word_tokenize("warm up")
+            with qas.lazy.timed('language_profiles'):
+                load_language_profiles()
+
+        def store():
+            self.structural_index  # pylint: disable=pointless-statement
+            self.template_index  # pylint: disable=pointless-statement
+
+        def run(name, target):
+            try:
+                target()
+            except Exception:  # pylint: disable=broad-except
+                # the component is loaded again on the first use
+                self.log.exception('Warm-up of %s failed.', name)
+
+        started = time.time()
+        threads = [threading.Thread(target=run,
+                                    args=(name, target, ),
+                                    name="warm-up-" + name,
+                                    daemon=True)
+                   for name, target in [("spacy", spacy_model),
+                                        ("synonyms", synonyms),
+                                        ("langdetect", language_profiles),
+                                        ("store", store)]]
+        for thread in threads:
+            thread.start()
+
+        def wait():
+            for thread in threads:
+                thread.join()
+            qas.lazy.TIMINGS['warm_up'] = time.time() - started
+            self.log.info('System is ready (warmed up in %.2fs).',
+                          time.time() - started)
+            self.ready.set()
+        threading.Thread(target=wait, name="warm-up", daemon=True).start()
+        return self.ready
+
+    def reopen(self):
+        """
+        Open the knowledge store connection and the label filter
+        mapping again in a forked process (SQLite connections must not
+        be used across fork, the parent closes the store before it).
+        """
+        self.store.open()
+        label_filter = \
+            self.settings['DEFAULT'].get('label_filter', '').strip()
+        if label_filter:
+            qas.items.use_label_filter(
+                qas.bloom.BloomFilter.load(label_filter))
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait for the warm-up.
+
+        Args:
+            timeout (float): seconds to wait or None (no limit).
+
+        Returns:
+            bool: system is ready.
+        """
+        return self.ready.wait(timeout)
 
     def __enter__(self):
         """
@@ -106,7 +391,14 @@ class QASystem(qas.logs.LoggingService):
             ___ (TYPE): unused argument.
         """
         self.log.info('Cleaning it up...')
-        self.db.close()
+        self.store.close()
+        if qas.items.LABEL_INDEX is not None:
+            qas.items.LABEL_INDEX.close()
+            qas.items.use_label_index(None)
+        if qas.items.LABEL_FILTER is not None:
+            # learned labels are kept in the filter file
+            qas.items.LABEL_FILTER.close()
+            qas.items.use_label_filter(None)
 
     def add_output_queue(self, logging_queue):
         """
@@ -129,8 +421,117 @@ class QASystem(qas.logs.LoggingService):
         Returns:
             qas.sentence.Sentence, qas.items.EntitySet:
                 parsed sentence, entities set or None.
+
+        Raises:
+            InvalidSentence: sentence can't be processed.
+        """
+        result = self.process_sentences([text])[0]
+        if result is None:
+            raise InvalidSentence()
+        return result
+
+    def process_sentences(self, texts, interrupted=None):
+        """
+        Process several sentences with a single linking batch.
+        Permutations shared by noun phrases of all sentences are
+        searched only once.
+
+        Args:
+            texts (list of str): sentences texts.
+            interrupted (set): positions of sentences, which some
+                searches failed for (the result may differ next time),
+                are added to the set.
+
+        Returns:
+            list: (qas.sentence.Sentence, list of qas.items.EntitySet)
+                pairs, None for invalid sentences.
+        """
+        results = [None] * len(texts)
+        texts = [qas.cache.normalize_text(text) for text in texts]
+        # parse all sentences in a single spaCy batch
+        docs = self.nlp.pipe(texts) if len(texts) > 1 else [None] * len(texts)
+        # sentence position -> (normalized text, sentence, noun phrases)
+        pending = {}
+        for position, (text, doc) in enumerate(zip(texts, docs)):
+
+            # known sentence, skip linking
+            cached = self.sentence_cache.get(text)
+            if cached is not None:
+                self.log.debug('Sentence loaded from the cache.')
+                sentence = qas.sentence.Sentence(
+                    text,
+                    nlp=self.nlp,
+                    log=self.log,
+                    settings=self.settings,
+                    doc=doc)
+                entities_sets = self.restore_entities_sets(sentence, cached)
+                self.log.info('%d enitites sets loaded.',
+                              len(entities_sets))
+                results[position] = (sentence, entities_sets, )
+                continue
+
+            try:
+                sentence, indexed_noun_phrases = self.parse_sentence(text,
+                                                                     doc=doc)
+            except InvalidSentence:
+                continue
+            pending[position] = (text, sentence, indexed_noun_phrases, )
+
+        if len(pending) == 0:
+            return results
+
+        # parallel enitites linking (all sentences at once)
+        indexed_noun_phrases = []
+        for position in sorted(pending):
+            indexed_noun_phrases += pending[position][2]
+        failed = set()
+        permuted_noun_phrases, matching = \
+            qas.items.matching_parallel(
+                indexed_noun_phrases,
+                disable_wordnet=self.settings['DEFAULT'].getboolean(
+                    'disable_wordnet'),
+                limit=self.max_permutations(),
+                failed=failed)
+
+        # fan linking results out to sentences
+        offset = 0
+        for position in sorted(pending):
+            text, sentence, sentence_noun_phrases = pending[position]
+            count = len(sentence_noun_phrases)
+            sentence_permuted = permuted_noun_phrases[offset:offset + count]
+            entities_sets = self.link_sentence(sentence_permuted, matching)
+            offset += count
+            # results of failed searches are not kept across restarts
+            if any(qas.label_index.normalize_label(permutation.text)
+                   in failed
+                   for _, _, permutations in sentence_permuted
+                   for permutation in permutations):
+                self.log.warning('Some searches failed, the sentence '
+                                 'is not cached.')
+                if interrupted is not None:
+                    interrupted.add(position)
+            else:
+                self.sentence_cache.put(
+                    text,
+                    [entities_set.dump() for entities_set in entities_sets])
+            results[position] = (sentence, entities_sets, )
+        return results
+
+    def parse_sentence(self, text, doc=None):
         """
+        Check and parse sentence, extract noun phrases.
+
+        Args:
+            text (str): sentence text.
+            doc (spacy.tokens.Doc): already parsed text or None.
+
+        Returns:
+            qas.sentence.Sentence, list: parsed sentence and
+                (root index, noun phrase) pairs.
 
+        Raises:
+            InvalidSentence: sentence isn't supported.
+        """
         # check, that the text is in English
         text_language = self.check_language(text)
         if text_language != 'en':
@@ -156,7 +557,8 @@ Please use one sentence per request.',
             text,
             nlp=self.nlp,
             log=self.log,
-            settings=self.settings)
+            settings=self.settings,
+            doc=doc)
         # extract noun phrases
         indexed_noun_phrases = sentence.get_noun_phrases()
         self.log.debug('%d noun phrases extracted from the sentence.',
@@ -171,12 +573,20 @@ Please use one sentence per request.',
                 print(token.text, end=" ")
         print("")
 
-        # parallel enitites linking
-        permuted_noun_phrases, matching = \
-            qas.items.matching_parallel(
-                indexed_noun_phrases,
-                disable_wordnet=self.settings['DEFAULT']['disable_wordnet'])
+        return sentence, indexed_noun_phrases
 
+    def link_sentence(self, permuted_noun_phrases, matching):
+        """
+        Create merged and strictified entities sets of a sentence.
+
+        Args:
+            permuted_noun_phrases (list): (index, noun phrase,
+                permutations) tuples of the sentence.
+            matching (dict): search results of permutations.
+
+        Returns:
+            list of qas.items.EntitySet: entities sets.
+        """
         # converting noun phrases into enitites
         # (objects linked with a knowledge base)
         entities = []
@@ -195,16 +605,6 @@ Please use one sentence per request.',
             self.log.debug("Entity created for '%s'.", noun_phrase.text)
         self.log.info('%d entities linked in total.', len(entities))
 
-        # print found entities
-        # for idx in sorted(root_np_idxs):
-        #     for token in sentence.spacy_doc:
-        #         if token.i == idx:
-        #             print("Root Noun: {}".format(token.text))
-        #     for idx2, noun_phrase in indexed_noun_phrases:
-        #         if idx == idx2:
-        #             print("Root Noun phrase: {}".format(noun_phrase.text))
-        # # test
-
         # entities sets is merged enitities
         # create initial list (enitity to enities set)
         entities_sets = [qas.items.EntitySet([entity[1]], log=self.log)
@@ -222,22 +622,273 @@ Please use one sentence per request.',
         # for entity_set in entities_sets:
         #     print(entity_set)
 
-        return sentence, entities_sets
+        return entities_sets
 
-    def lookup(self, sentence, enitites_sets_count=None):
-        # implement parse tree constructing via classmethod
+    def max_permutations(self):
+        """
+        Maximal permutations count per noun phrase (None - unlimited).
+        """
+        value = self.settings['DEFAULT'].get('max_permutations', '').strip()
+        return int(value) if value else None
+
+    def create_sentence_cache(self):
+        """
+        Create processed sentences cache using the configuration.
+        Linking settings are a part of the cache fingerprint.
+
+        Returns:
+            qas.cache.SentenceCache: cache (in memory only if
+            sentence_cache_filename option is empty).
+        """
+        settings = self.settings['DEFAULT']
+        filename = settings.get('sentence_cache_filename', '').strip()
+        size = int(settings.get('sentence_cache_size', '').strip() or
+                   qas.cache.SENTENCE_CACHE_SIZE)
+        fingerprint = tuple(settings.get(option, '')
+                            for option in ('spacy_model',
+                                           'disable_wordnet',
+                                           'label_index',
+                                           'fuzzy_linking',
+                                           'label_filter',
+                                           'max_permutations',
+                                           'synonym_table'))
+        # a rebuilt synonyms table changes permutations as well
+        synonym_table = settings.get('synonym_table', '').strip()
+        if synonym_table and os.path.exists(synonym_table):
+            fingerprint += (os.path.getmtime(synonym_table), )
+        return qas.cache.SentenceCache(filename or None,
+                                       size=size,
+                                       fingerprint=fingerprint)
+
+    def restore_entities_sets(self, sentence, data):
+        """
+        Create entities sets from the cached representation.
+
+        Args:
+            sentence (qas.sentence.Sentence): parsed sentence.
+            data (list): dumped entities sets (EntitySet.dump).
+
+        Returns:
+            list of qas.items.EntitySet: entities sets.
+        """
+        entities_sets = []
+        for entities_set_data in data:
+            entities = []
+            for entity_data in entities_set_data:
+                noun_phrase = qas.noun_phrase.RootNounPhrase(
+                    [sentence.spacy_doc[idx]
+                     for idx in entity_data['tokens']])
+                candidates = [
+                    qas.items.ItemsBatch(
+                        qas.noun_phrase.NounPhrase(text.split()),
+                        raw=raw,
+                        view=view)
+                    for text, raw, view in entity_data['candidates']]
+                entities.append(qas.items.Entity(noun_phrase,
+                                                 candidates=candidates,
+                                                 log=self.log))
+            entities_sets.append(qas.items.EntitySet(entities,
+                                                     log=self.log))
+        return entities_sets
+
+    def lookup(self, sentence, enitites_sets_count=None, entities_sets=None,
+               matches=None):
+        """
+        Find the most similar reference question for the sentence.
+        Question templates are checked first, then references sharing
+        linked entities (or their types), then stored questions are
+        compared by precomputed vectors (or only structurally similar
+        ones are parsed without the vector index).
+
+        Args:
+            sentence (qas.sentence.Sentence): question.
+            entities_sets (list of qas.items.EntitySet): linked entities
+                of the question.
+            matches (list): precomputed vector index top_k result.
+
+        Returns:
+            dict: knowledge record or None.
+        """
+        if entities_sets is not None:
+            record_ids = qas.items.unique_items(
+                self.template_index.get(template_hash)
+                for template_hash in qas.template_index.template_hashes(
+                    sentence.spacy_doc, entities_sets))
+            record_ids = [record_id for record_id in record_ids
+                          if record_id is not None]
+            if len(record_ids):
+                # a shared template is still checked by similarity
+                reference = self.best_reference(
+                    self.score_references(sentence, record_ids))
+                if reference is not None:
+                    print("Template\t| {}".format(reference['question']))
+                    return reference
+
+            # cheap candidates, which share entities with the question
+            candidates = self.entity_candidates(entities_sets)
+            if len(candidates):
+                reference = self.best_reference(
+                    self.score_references(sentence, candidates))
+                if reference is not None:
+                    return reference
+
+        if matches is None:
+            if self.vector_index is not None and \
+               not self.vector_index.approximate:
+                # all stored questions are scored
+                matches = self.vector_index.top_k(sentence.spacy_doc.vector)
+            else:
+                candidates = [record_id
+                              for _, record_id
+                              in self.structural_index.top_k(sentence.tree)]
+                if self.vector_index is not None:
+                    matches = self.vector_index.top_k(
+                        sentence.spacy_doc.vector,
+                        include=candidates)
+                else:
+                    matches = self.score_references(sentence, candidates)
+        return self.best_reference(matches)
+
+    def score_references(self, sentence, record_ids):
+        """
+        Similarities of the sentence and the given stored questions.
+
+        Returns:
+            list: (similarity, record id) pairs, the best first.
+        """
+        if self.vector_index is not None:
+            return self.vector_index.score(sentence.spacy_doc.vector,
+                                           record_ids)
+        matches = [(sentence.spacy_doc.similarity(
+                        self.nlp(self.store[record_id]['question'])),
+                    record_id, )
+                   for record_id in record_ids]
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return matches
+
+    def best_reference(self, matches):
+        """
+        Print scored references, return the best one above the threshold.
+        """
         threshold = float(self.settings['DEFAULT']['similarity_threshold'])
-        sentence_doc = self.nlp(sentence.text)
+        if len(matches) == 0:
+            return None
         print("Score\t| Reference")
         print("-" * 20)
-        for reference in self.db['knowledge']:
-            ref_doc = self.nlp(reference['question'])
-            similarity = sentence_doc.similarity(ref_doc)
-            print("{:.4f}\t| {}".format(similarity, reference['question']))
-            if similarity > threshold:
-                return reference
+        for similarity, record_id in matches:
+            print("{:.4f}\t| {}".format(similarity,
+                                        self.store[record_id]['question']))
+        similarity, record_id = matches[0]
+        if similarity > threshold:
+            return self.store[record_id]
         return None
 
+    def entity_candidates(self, entities_sets):
+        """
+        Stored records sharing linked items or their types
+        with the question.
+
+        Args:
+            entities_sets (list of qas.items.EntitySet): question entities.
+
+        Returns:
+            list of int: record ids, sharing items first.
+        """
+        item_ids = qas.items.unique_items(item_id
+                                          for entities_set in entities_sets
+                                          for item_id in entities_set.item_ids)
+        if len(item_ids) == 0 or len(self.store) == 0:
+            return []
+        candidates = self.store.records_by_items(item_ids)
+        # only locally stored types, lookups don't wait for Wikidata
+        candidates += self.store.records_by_types(self.item_types(item_ids))
+        return list(qas.items.unique_items(candidates))
+
+    def item_types(self, item_ids, budget=None):
+        """
+        Types (instance of) of the items. Types are stored locally,
+        unknown ones are asked from Wikidata only with a budget (empty
+        if Wikidata doesn't respond).
+
+        Args:
+            item_ids (iterable of str): Wikidata item ids.
+            budget (qas.graph.SearchBudget): limits of the types query
+                or None to use only locally known types.
+
+        Returns:
+            list of str: unique type ids.
+        """
+        item_ids = list(item_ids)
+        types = self.store.item_types(item_ids)
+        missing = [item_id for item_id in item_ids if item_id not in types]
+        if len(missing) and budget is not None:
+            try:
+                budget.start()
+                budget.check()
+                fetched = qas.wikidata.Wikidata.get_types(
+                    missing, timeout=budget.query_timeout())
+            except (qas.graph.SearchBudgetExhausted,
+                    qas.wikidata.NoSPARQLResponse,
+                    OSError, ValueError, KeyError) as error:
+                self.log.warning('Types of %d items are not available '
+                                 '(%s).', len(missing),
+                                 type(error).__name__)
+            else:
+                self.store.add_item_types(fetched, commit=False)
+                types.update(fetched)
+        return list(qas.items.unique_items(
+            type_id
+            for item_id in item_ids
+            for type_id in types.get(item_id, [])))
+
+    def create_vector_index(self):
+        """
+        Open vector index of stored questions and add vectors
+        of the records, which are not indexed yet.
+
+        Returns:
+            qas.vector_index.VectorIndex: index or None if disabled.
+        """
+        filename = self.settings['DEFAULT'].get('vector_index', '').strip()
+        if not filename:
+            return None
+        dimension = len(self.nlp("question").vector)
+        if dimension == 0:
+            self.log.warning('spaCy model %s has no vectors, '
+                             'vector index is disabled.',
+                             self.settings['DEFAULT']['spacy_model'])
+            return None
+        vector_index = qas.vector_index.VectorIndex(
+            filename,
+            dimension,
+            approximate=self.settings['DEFAULT'].getboolean(
+                'approximate_lookup', fallback=False))
+        count = len(self.store)
+        vector_index.truncate(count)
+        if len(vector_index) < count:
+            self.log.info('Computing vectors of %d known questions',
+                          count - len(vector_index))
+        for _, question in self.store.questions(start=len(vector_index)):
+            vector_index.add(self.nlp(question).vector)
+        return vector_index
+
+    def build_structural_index(self):
+        """
+        Index all stored questions (once for an old database).
+
+        Returns:
+            qas.structural_index.StructuralIndex: index.
+        """
+        index = qas.structural_index.StructuralIndex()
+        self.log.info('Indexing %d known questions', len(self.store))
+        for record_id, question in self.store.questions():
+            tree = qas.sentence.ParseTree(self.nlp(question))
+            index.add(record_id, tree)
+            self.store.add_links(record_id, tree.strict_signatures,
+                                 commit=False)
+        self.store.commit()
+        return index
+
     def answer(self, question):
         """
         Primary method to answer a question.
@@ -249,37 +900,89 @@ Please use one sentence per request.',
         Returns:
             TYPE: Description
         """
+        return self.answer_many([question])[0]
 
-        self.log.info("Processing question: '%s'", question)
-        try:
-            question_sentence, entities_sets = self.process_sentence(question)
-        except InvalidSentence:
-            return None
+    def answer_many(self, questions, concurrency=None):
+        """
+        Answer several questions at once.
 
-        if len(entities_sets) == 0:
-            self.log.error("System wasn't able to find noun entities in"
-                           " the sentence.")
-            return
+        Sentences are parsed in a single spaCy batch and linked with
+        a single search batch, references are looked up with a single
+        matrix product. Graph searches of the questions run concurrently.
 
-        print("==== MATCHED QUESTION ====")
-        for entity_set in entities_sets:
-            print(entity_set)
+        Args:
+            questions (list of str): input sentences.
+            concurrency (int): maximal number of concurrent searches
+                (answer_concurrency option by default).
+
+        Returns:
+            list: answers (None for unanswered questions).
+        """
+        for question in questions:
+            self.log.info("Processing question: '%s'", question)
+        processed = self.process_sentences(questions)
+
+        # questions with entities
+        positions = []
+        for position, result in enumerate(processed):
+            if result is None:
+                continue
+            if len(result[1]) == 0:
+                self.log.error("System wasn't able to find noun entities in"
+                               " the sentence.")
+                continue
+            positions.append(position)
 
+        # references lookup (vector search in a single batch)
         self.log.info('Looking for a refrence sentence.')
-        reference = self.lookup(question_sentence,
-                                enitites_sets_count=len(entities_sets))
-
-        if reference is not None:
-            self.log.info('Applying knownledge path')
-            result = self.reference_answering(question_sentence,
-                                              entities_sets,
-                                              reference)
-            if result is not None:
-                return result
-
-        # if no reference or reference is not applicable
-        result = self.blind_answer(question_sentence, entities_sets)
-        return result
+        vectors_matches = [None] * len(positions)
+        if self.vector_index is not None and \
+           not self.vector_index.approximate and len(positions) > 1:
+            vectors_matches = self.vector_index.top_k_many(
+                [processed[position][0].spacy_doc.vector
+                 for position in positions])
+        references = {}
+        for position, matches in zip(positions, vectors_matches):
+            question_sentence, entities_sets = processed[position]
+            print("==== MATCHED QUESTION ====")
+            for entity_set in entities_sets:
+                print(entity_set)
+            references[position] = self.lookup(
+                question_sentence,
+                enitites_sets_count=len(entities_sets),
+                entities_sets=entities_sets,
+                matches=matches)
+
+        def answer_question(position):
+            question_sentence, entities_sets = processed[position]
+            reference = references[position]
+            if reference is not None:
+                self.log.info('Applying knownledge path')
+                result = self.reference_answering(question_sentence,
+                                                  entities_sets,
+                                                  reference)
+                if result is not None:
+                    return result
+
+            # if no reference or reference is not applicable
+            return self.blind_answer(question_sentence, entities_sets)
+
+        # graph searches (concurrently)
+        answers = [None] * len(questions)
+        if concurrency is None:
+            concurrency = self.settings['DEFAULT'].getint(
+                'answer_concurrency', fallback=1)
+        if len(positions) <= 1 or concurrency <= 1:
+            for position in positions:
+                answers[position] = answer_question(position)
+            return answers
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=concurrency) as executor:
+            futures = {executor.submit(answer_question, position): position
+                       for position in positions}
+            for future in concurrent.futures.as_completed(futures):
+                answers[futures[future]] = future.result()
+        return answers
 
     def reference_answering(self, question_sentence, entities_sets, reference):
         items_list = []
@@ -346,12 +1049,24 @@ Please use one sentence per request.',
                 labels.append(label)
                 labeled_entities.append((label, entity, ))
 
+        # all labels are connected by a single joint search, its budget
+        # is shared: neighborhoods of all labels are expanded together
         graph_ = qas.graph.Graph(labeled_entities)
-        combinations = itertools.combinations(labels, 2)
-        solutions = {}
-        for direction_from, direction_to in combinations:
-            print("Processing direction:", direction_from, direction_to)
-            solutions.update(graph_.connect(direction_from, direction_to))
+        budget = self.search_budget()
+        labels = sorted(set(labels))
+        solutions = graph_.connect_terminals(*labels, budget=budget)
+        # the joint search follows direct links only, pairs it hasn't
+        # connected are searched through statements and qualifiers too
+        missing = [pair
+                   for pair in itertools.combinations(labels, 2)
+                   if frozenset(pair) not in solutions]
+        if len(missing):
+            solutions = dict(solutions)
+            for pair, pair_budget in zip(missing,
+                                         budget.split(len(missing))):
+                print("Processing direction:", *pair)
+                solutions.update(graph_.connect(*pair, budget=pair_budget))
+        self.log_budget(budget)
 
         if len(solutions) == 0:
             self.log.error("Connection at graph wasn't found.")
@@ -384,6 +1099,36 @@ Please use one sentence per request.',
             print("https://www.wikidata.org/wiki/{}".format(item))
         return result
 
+    def search_budget(self):
+        """
+        Create a graph search budget using the configuration.
+        Empty or missing option means unlimited resource.
+
+        Returns:
+            qas.graph.SearchBudget: limits for a single search.
+        """
+        def option(name, type_):
+            value = self.settings['DEFAULT'].get(name, '').strip()
+            return type_(value) if value else None
+        return qas.graph.SearchBudget(
+            time_limit=option('search_time_budget', float),
+            queries_limit=option('search_queries_budget', int),
+            rows_limit=option('search_rows_budget', int))
+
+    def log_budget(self, budget):
+        """
+        Log resources used by a graph search.
+
+        Args:
+            budget (qas.graph.SearchBudget): used budget.
+        """
+        self.log.info('Graph search used %.2fs, %d queries, %d rows.',
+                      budget.elapsed, budget.queries, budget.rows)
+        if budget.exhausted is not None:
+            self.log.warning('Graph search budget exhausted (%s), '
+                             'using the best paths found so far.',
+                             budget.exhausted)
+
     @staticmethod
     def check_sentence(text):
         """
@@ -404,7 +1149,8 @@ Please use one sentence per request.',
             MultipleSentenceQuestion: in case of more than one sentence inside
             of the text string.
         """
-        sent_tokenize_list = sent_tokenize(text)  # nltk tokenize sentence
+        # nltk tokenize sentence
+        sent_tokenize_list = qas.lazy.nltk_tokenize.sent_tokenize(text)
         if len(sent_tokenize_list) > 1:
             raise MultipleSentences(sent_tokenize_list)
 
@@ -428,9 +1174,10 @@ Please use one sentence per request.',
             shorter than 3 words.
         """
         # possibly langdetect.detect_langs(text)
-        if len(word_tokenize(text)) <= 2:
+        if len(qas.lazy.nltk_tokenize.word_tokenize(text)) <= 2:
             return 'en'
-        return langdetect.detect(text)
+        load_language_profiles()
+        return qas.lazy.langdetect.detect(text)
 
     def extend(self, question, answer,
                question_entities_sets=None,
@@ -439,8 +1186,14 @@ Please use one sentence per request.',
         Try to learn a new knowledge from question-answer pair.
         """
 
-        # process question
+        # process question and answer (single linking batch)
+        question_sentence = None
         try:
+            if question_entities_sets is None and \
+               answer_entities_sets is None:
+                (question_sentence, question_entities_sets), \
+                    (_, answer_entities_sets) = \
+                    self.get_sentences_entities_sets([question, answer])
             if question_entities_sets is None:
                 question_entities_sets = self.get_entities_set(question)
             if answer_entities_sets is None:
@@ -450,55 +1203,373 @@ Please use one sentence per request.',
             return None
 
         result = self.extend_sets(question_entities_sets, answer_entities_sets)
+        if result is None:
+            print("* extension skipped *")
+            return None
 
         # save data to the database
-        skip_flag = False
-        for pair in self.db['knowledge']:
-            if pair['question'] == question:
-                skip_flag = True
-        if not skip_flag:
-            record = {}
-            record['question'] = question
-            record['answer'] = answer
-            items = []
-            for entities_set in question_entities_sets + answer_entities_sets:
-                items += [item.wd_item_id for item in entities_set.items]
-            record['items'] = items
-            record['solution'] = [{
-                                    "path": sol[1].path,
-                                    "config": list(sol[1].config)
-                                  }
-                                  for sol in result[-10:]]
-            temporary = self.db['knowledge']
-            temporary.append(record)
-            self.db['knowledge'] = temporary
+        if self.save_record(question, answer,
+                            question_sentence,
+                            question_entities_sets,
+                            answer_entities_sets,
+                            result):
             print("* pairs db updated *")
         else:
             print("* extension skipped *")
 
         return result
 
+    def extend_many(self, pairs, processes=None, checkpoint=None):
+        """
+        Learn many question-answer pairs (bulk extension).
+
+        Pairs are linked in batches, graph searches run in a pool
+        of processes sharing the SPARQL responses cache. Records of
+        a batch are committed together and learned or definitively
+        rejected pairs are written to the checkpoint, so an interrupted
+        run continues with the rest of the pairs. Pairs, which failed
+        because of timeouts or the exhausted budget, are postponed
+        (searched again by the next run).
+
+        Args:
+            pairs (list): (question, answer) pairs.
+            processes (int): number of search processes
+                (extend_processes option by default).
+            checkpoint (str): checkpoint file (extend_checkpoint option
+                by default, empty disables it).
+
+        Returns:
+            dict: processed, learned, failed and postponed pairs counts
+                and elapsed time.
+        """
+        defaults = self.settings['DEFAULT']
+        if processes is None:
+            processes = defaults.getint('extend_processes', fallback=1)
+        if checkpoint is None:
+            checkpoint = defaults.get('extend_checkpoint', '').strip()
+        batch_size = defaults.getint('extend_batch_size',
+                                     fallback=EXTEND_BATCH_SIZE)
+        checkpoint = qas.cache.Checkpoint(checkpoint or None)
+        pending = [(question, answer, )
+                   for question, answer in pairs
+                   if qas.cache.Checkpoint.key(question, answer)
+                   not in checkpoint]
+        self.log.info('%d pairs to learn (%d already processed).',
+                      len(pending), len(pairs) - len(pending))
+
+        budget = self.search_budget()
+        budget_limits = (budget.time_limit,
+                         budget.queries_limit,
+                         budget.rows_limit, )
+        stats = {"processed": 0, "learned": 0, "failed": 0, "postponed": 0}
+        started = time.time()
+        manager = None
+        pool = None
+        sparql_cache = qas.wikidata.CACHE['sparql']
+        if processes > 1:
+            # forked processes must not inherit the SQLite connection
+            self.store.close()
+            try:
+                manager = multiprocessing.Manager()
+                pool = multiprocessing.Pool(
+                    processes,
+                    initializer=init_extend_worker,
+                    initargs=(manager.dict(), budget_limits, ))
+            finally:
+                self.store.open()
+            search = pool.imap_unordered
+        else:
+            init_extend_worker({}, budget_limits)
+            search = map
+        try:
+            for offset in range(0, len(pending), batch_size):
+                batch = pending[offset:offset + batch_size]
+                done = self.extend_batch(batch, search, stats)
+                checkpoint.add(qas.cache.Checkpoint.key(question, answer)
+                               for question, answer in done)
+                elapsed = time.time() - started
+                self.log.info('%d/%d pairs processed, %d learned, '
+                              '%.2f pairs/s.',
+                              stats['processed'],
+                              len(pending),
+                              stats['learned'],
+                              stats['processed'] / max(elapsed, 1e-6))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                manager.shutdown()
+            qas.wikidata.use_sparql_cache(sparql_cache)
+        stats['elapsed'] = time.time() - started
+        return stats
+
+    def extend_batch(self, batch, search, stats):
+        """
+        Link a batch of pairs at once, search and save them.
+
+        Args:
+            batch (list): (question, answer) pairs.
+            search (callable): map of extend_worker over tasks
+                (possibly unordered).
+            stats (dict): counters to update.
+
+        Returns:
+            list: (question, answer) pairs, which are done (learned,
+                known or definitively rejected).
+        """
+        interrupted = set()
+        processed = self.process_sentences(
+            [text for pair in batch for text in pair],
+            interrupted=interrupted)
+        done = []
+        linked = {}
+        tasks = []
+        for position, (question, _) in enumerate(batch):
+            question_result = processed[2 * position]
+            answer_result = processed[2 * position + 1]
+            if question_result is None or answer_result is None or \
+               len(question_result[1]) == 0 or len(answer_result[1]) == 0:
+                self.log.error("Unable to process the pair: '%s'", question)
+                if 2 * position in interrupted or \
+                   2 * position + 1 in interrupted:
+                    stats['postponed'] += 1
+                else:
+                    stats['failed'] += 1
+                    done.append(batch[position])
+                continue
+            if self.store.find_question(question) is not None:
+                done.append(batch[position])
+                continue
+            linked[position] = (question_result, answer_result, )
+            tasks.append((position,
+                          [qas.items.ItemsEntity.dump(entity)
+                           for entities_set in question_result[1]
+                           for entity in entities_set.set],
+                          [qas.items.ItemsEntity.dump(entity)
+                           for entities_set in answer_result[1]
+                           for entity in entities_set.set], ))
+
+        for position, solutions, types, searches_interrupted in \
+                search(extend_worker, tasks):
+            if solutions is None:
+                if searches_interrupted or \
+                   2 * position in interrupted or \
+                   2 * position + 1 in interrupted:
+                    stats['postponed'] += 1
+                else:
+                    stats['failed'] += 1
+                    done.append(batch[position])
+                continue
+            (question_sentence, question_entities_sets), \
+                (_, answer_entities_sets) = linked[position]
+            items = {item.wd_item_id: item
+                     for entities_set in question_entities_sets
+                     for item in entities_set.items}
+            solutions = [(score,
+                          qas.graph.Path(path,
+                                         tuple(config),
+                                         items.get(item_from),
+                                         None), )
+                         for score, path, config, item_from in solutions]
+            question, answer = batch[position]
+            self.store.add_item_types(types, commit=False)
+            if self.save_record(question, answer,
+                                question_sentence,
+                                question_entities_sets,
+                                answer_entities_sets,
+                                solutions,
+                                commit=False,
+                                fetch_types=False):
+                stats['learned'] += 1
+            done.append(batch[position])
+        self.store.commit()
+        stats['processed'] += len(batch)
+        return done
+
+    def save_record(self, question, answer,
+                    question_sentence,
+                    question_entities_sets,
+                    answer_entities_sets,
+                    solutions,
+                    commit=True,
+                    fetch_types=True):
+        """
+        Save a learned question-answer pair and update indexes.
+
+        Args:
+            question (str): question.
+            answer (str): answer.
+            question_sentence (qas.sentence.Sentence): parsed question
+                or None.
+            question_entities_sets (list of qas.items.EntitySet): question
+                entities.
+            answer_entities_sets (list of qas.items.EntitySet): answer
+                entities.
+            solutions (list): evaluated (score, qas.graph.Path) pairs,
+                the best last.
+            commit (bool): commit the store transaction.
+            fetch_types (bool): ask Wikidata for types of the question
+                items, which aren't stored locally (otherwise only
+                stored types are used).
+
+        Returns:
+            bool: record was saved (False for a known question).
+
+        Indexes are loaded lazily, rows of the vector index stay aligned
+        with record ids when the first save loads them:
+
+        >>> import os, tempfile
+        >>> from types import SimpleNamespace as Namespace
+        >>> import numpy
+        >>> directory = tempfile.mkdtemp()
+        >>> config = os.path.join(directory, 'config.ini')
+        >>> with open(config, 'w') as config_file:
+        ...     _ = config_file.write("\\n".join([
+        ...         "[DEFAULT]",
+        ...         "store_filename = " + os.path.join(directory, "db"),
+        ...         "db_filename = " + os.path.join(directory, "old"),
+        ...         "vector_index = " + os.path.join(directory, "vectors"),
+        ...         "sentence_cache_filename ="]))
+        >>> qa_system = QASystem(config=config)
+        >>> qa_system._nlp = lambda text: Namespace(vector=numpy.ones(3))
+        >>> solutions = [(1.0, Namespace(path=[], config=(),
+        ...                              item_from=None), )]
+        >>> for question in ["First?", "Second?"]:
+        ...     sentence = Namespace(
+        ...         tree=Namespace(strict_signatures=[len(question)]),
+        ...         spacy_doc=Namespace(vector=numpy.ones(3)))
+        ...     _ = qa_system.save_record(question, "answer", sentence,
+        ...                               [], [], solutions,
+        ...                               fetch_types=False)
+        >>> len(qa_system.vector_index) == len(qa_system.store) == 2
+        True
+        """
+        if self.store.find_question(question) is not None:
+            return False
+        record = {}
+        record['question'] = question
+        record['answer'] = answer
+        items = []
+        for entities_set in question_entities_sets + answer_entities_sets:
+            items += [item.wd_item_id for item in entities_set.items]
+        record['items'] = items
+        record['solution'] = [{
+                                "path": sol[1].path,
+                                "config": list(sol[1].config)
+                              }
+                              for sol in solutions[-10:]]
+
+        # question structure and template
+        if question_sentence is None:
+            question_sentence = qas.sentence.Sentence(
+                question,
+                nlp=self.nlp,
+                log=self.log,
+                settings=self.settings)
+        template_hash = None
+        slot = self.template_slot(question_entities_sets, solutions)
+        if slot is not None:
+            # template of the best permutation linking the start item
+            template_hashes = qas.template_index.template_hashes(
+                question_sentence.spacy_doc, [slot],
+                solutions[-1][1].item_from.wd_item_id)
+            if len(template_hashes):
+                template_hash = template_hashes[0]
+        question_item_ids = qas.items.unique_items(
+            item_id
+            for entities_set in question_entities_sets
+            for item_id in entities_set.item_ids)
+        # indexes are loaded from the store before the record is added,
+        # otherwise the loaded indexes already cover it
+        structural_index = self.structural_index
+        vector_index = self.vector_index
+        template_index = self.template_index
+        self.store.add(record,
+                       signatures=question_sentence.tree.strict_signatures,
+                       template_hash=template_hash,
+                       types=self.item_types(
+                           question_item_ids,
+                           budget=self.search_budget() if fetch_types
+                           else None),
+                       commit=commit)
+
+        # update indexes
+        structural_index.add(record['id'], question_sentence.tree)
+        if vector_index is not None and len(vector_index) == record['id']:
+            # rows are record ids
+            vector_index.add(question_sentence.spacy_doc.vector)
+        if template_hash is not None:
+            template_index.add(template_hash, record['id'])
+        return True
+
+    @staticmethod
+    def template_slot(question_entities_sets, solutions):
+        """
+        Entities set of the question, which the best solution starts from.
+
+        Args:
+            question_entities_sets (list of qas.items.EntitySet): question
+                entities.
+            solutions (list): evaluated (score, qas.graph.Path) pairs,
+                the best last.
+
+        Returns:
+            qas.items.EntitySet: template slot or None.
+        """
+        item_from = solutions[-1][1].item_from
+        if item_from is None:
+            return None
+        for entities_set in question_entities_sets:
+            if item_from.wd_item_id in entities_set.item_ids:
+                return entities_set
+        return None
+
     def get_entities_set(self, sentence):
         """
         Produce entities set based on items list.
         """
-        # process sentence
-        self.log.info('Processing sentence: %s', sentence)
-        try:
-            _, entities_sets = self.process_sentence(sentence)
-        except InvalidSentence:
-            raise InvalidEntitiesSet()
-        if entities_sets is None:
-            self.log.error("System is unable to process the sentence.")
-            raise InvalidEntitiesSet()
+        return self.get_entities_sets([sentence])[0]
 
-        # check found enities length
-        if len(entities_sets) == 0:
-            self.log.error("System wasn't able to find noun entities in \
-the sentence.")
-            raise InvalidEntitiesSet()
+    def get_entities_sets(self, sentences):
+        """
+        Produce entities sets for several sentences
+        (linked together in a single batch).
 
-        return entities_sets
+        Raises:
+            InvalidEntitiesSet: any sentence can't be processed.
+        """
+        return [entities_sets
+                for _, entities_sets
+                in self.get_sentences_entities_sets(sentences)]
+
+    def get_sentences_entities_sets(self, sentences):
+        """
+        Produce parsed sentences and their entities sets
+        (linked together in a single batch).
+
+        Returns:
+            list: (qas.sentence.Sentence, list of qas.items.EntitySet)
+                pairs.
+
+        Raises:
+            InvalidEntitiesSet: any sentence can't be processed.
+        """
+        # process sentences
+        for sentence in sentences:
+            self.log.info('Processing sentence: %s', sentence)
+        results = self.process_sentences(sentences)
+        for result in results:
+            if result is None:
+                self.log.error("System is unable to process the sentence.")
+                raise InvalidEntitiesSet()
+            _, entities_sets = result
+
+            # check found enities length
+            if len(entities_sets) == 0:
+                self.log.error("System wasn't able to find noun entities \
+in the sentence.")
+                raise InvalidEntitiesSet()
+        return results
 
     def extend_sets(self,
                     question_entities_sets,
@@ -524,7 +1595,9 @@ the sentence.")
             print(entity_set)
 
         graph_ = qas.graph.Graph(labeled_entities)
-        solutions = graph_.connect("question", "answer")
+        budget = self.search_budget()
+        solutions = graph_.connect("question", "answer", budget=budget)
+        self.log_budget(budget)
         if len(solutions) == 0:
             self.log.error("Connection at graph wasn't found.")
             return None
@@ -0,0 +1,143 @@
+"""
+Fuzzy entities linking with a character trigram index.
+
+The trigram index is built over labels of the offline label index
+(qas.label_index) and stored as a sorted string table:
+
+    <prefix>.trigrams: trigram -> label rows of <prefix>.labels
+
+Single lookup per noun phrase returns labels ranked by the trigram
+similarity (Dice coefficient), so no permutations are needed.
+
+Usage:
+python3 -m qas.fuzzy_index index
+"""
+
+import array
+import heapq
+import sys
+
+from qas.sstable import Table, external_sort, group_rows, write_table
+from qas.label_index import LabelIndex, normalize_label, SEARCH_LIMIT
+
+MIN_SIMILARITY = 0.5
+MAX_POSTINGS = 50000  # skip too common trigrams
+CANDIDATE_LABELS = 50  # labels taken before items ranking
+
+
+def trigrams(text):
+    """
+    Character trigrams of the normalized text (padded by spaces).
+
+    >>> sorted(trigrams("Oslo"))
+    ['  o', ' os', 'lo ', 'osl', 'slo']
+
+    Args:
+        text (str): text to split.
+
+    Returns:
+        set of str: trigrams.
+    """
+    text = "  " + normalize_label(text) + " "
+    return set(text[idx:idx + 3] for idx in range(len(text) - 2))
+
+
+def build(prefix):
+    """
+    Build the trigram index for the existing label index.
+
+    Args:
+        prefix (str): index files prefix.
+    """
+    labels = Table(prefix + '.labels')
+    # (trigram, row) pairs are sorted externally
+    postings = external_sort(
+        (trigram.encode('utf-8'), row, )
+        for row in range(len(labels))
+        for trigram in trigrams(labels.key(row).decode('utf-8')))
+    try:
+        write_table(prefix + '.trigrams', group_rows(postings),
+                    presorted=True)
+    finally:
+        labels.close()
+
+
+class FuzzyIndex(LabelIndex):
+    """
+    Label index with the fuzzy (trigram) search.
+    """
+    def __init__(self, prefix):
+        super(FuzzyIndex, self).__init__(prefix)
+        self.trigrams = Table(prefix + '.trigrams')
+
+    def similar_labels(self, query, count=CANDIDATE_LABELS):
+        """
+        Labels similar to the query.
+
+        Args:
+            query (str): searched text.
+            count (int): maximal labels count.
+
+        Returns:
+            list: (similarity, label row) pairs, the best first.
+        """
+        query_trigrams = trigrams(query)
+        if len(query_trigrams) == 0:
+            return []
+        shared = {}
+        for trigram in query_trigrams:
+            value = self.trigrams.get(trigram.encode('utf-8'))
+            if value is None:
+                continue
+            rows = array.array('I', value)
+            if len(rows) > MAX_POSTINGS:
+                continue
+            for row in rows:
+                shared[row] = shared.get(row, 0) + 1
+        # Dice coefficient 2c / (q + l) with l >= c is at most
+        # 2c / (q + c), skip hopeless candidates before decoding labels
+        minimal = MIN_SIMILARITY * len(query_trigrams) / \
+            (2.0 - MIN_SIMILARITY)
+        scored = []
+        for row, common in shared.items():
+            if common < minimal:
+                continue
+            label = self.labels.key(row).decode('utf-8')
+            similarity = 2.0 * common / \
+                (len(query_trigrams) + len(trigrams(label)))
+            if similarity >= MIN_SIMILARITY:
+                scored.append((similarity, row, ))
+        return heapq.nlargest(count, scored)
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Fuzzy search of items by label or alias.
+        Items are ranked by the label similarity, then by sitelinks.
+
+        Returns:
+            list of dict: search results or None if nothing was found.
+        """
+        scored = {}
+        for similarity, label_row in self.similar_labels(query):
+            for row in self.rows(label_row):
+                score = (similarity, self.sitelinks(row), )
+                if row not in scored or scored[row] < score:
+                    scored[row] = score
+        if len(scored) == 0:
+            return None
+        rows = heapq.nlargest(limit, scored, key=scored.get)
+        return [self.entity(row) for row in rows]
+
+    def close(self):
+        super(FuzzyIndex, self).close()
+        self.trigrams.close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python3 -m qas.fuzzy_index INDEX_PREFIX")
+    build(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,210 @@ Graph exploration module.
 import itertools
 import time
 
-from qas.wikidata import Wikidata, NoSPARQLResponse
+from qas.wikidata import Wikidata, NoSPARQLResponse, DEFAULT_SPARQL_TIMEOUT
+from qas.items import unique_items
 
 MAX_PATH_LENGTH = 5
 DISABLE_PARALLEL = True
 RETRY_PARALLEL_SPARQL = False
 
+# default budgets of a single search (None means unlimited)
+MAX_SEARCH_TIME = None  # seconds
+MAX_SEARCH_QUERIES = None
+MAX_SEARCH_ROWS = None
+
+# joint (multi-terminal) search settings
+NEIGHBORHOOD_BATCH = 20  # nodes per a neighborhood query
+NEIGHBORHOOD_LIMIT = 500  # links per a node of the batch
+MAX_ROUTES_PER_NODE = 5  # partial routes kept per node and label
+
+
+class SearchBudgetExhausted(Exception):
+    """
+    Exception for the exhausted search budget.
+
+    Attributes:
+        reason (str): name of the exhausted resource.
+    """
+    def __init__(self, reason):
+        super(SearchBudgetExhausted, self).__init__(reason)
+        self.reason = reason
+
+
+class SearchBudget(object):
+    """
+    Resources limits and accounting of a single graph search.
+
+    Attributes:
+        time_limit (float): wall time limit in seconds (None - unlimited).
+        queries_limit (int): SPARQL queries limit (None - unlimited).
+        rows_limit (int): SPARQL result rows limit (None - unlimited).
+        queries (int): issued SPARQL queries.
+        rows (int): received SPARQL result rows.
+        failures (int): queries without a response (timeouts).
+        exhausted (str): reason of the interruption or None.
+        parent (SearchBudget): budget, which the budget is a share of
+            (charged as well) or None.
+    """
+    def __init__(self,
+                 time_limit=MAX_SEARCH_TIME,
+                 queries_limit=MAX_SEARCH_QUERIES,
+                 rows_limit=MAX_SEARCH_ROWS,
+                 parent=None):
+        self.time_limit = time_limit
+        self.queries_limit = queries_limit
+        self.rows_limit = rows_limit
+        self.parent = parent
+        self.started = None
+        self.queries = 0
+        self.rows = 0
+        self.failures = 0
+        self.exhausted = None
+
+    def start(self):
+        if self.started is None:
+            self.started = time.time()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return time.time() - self.started
+
+    @property
+    def remaining_time(self):
+        if self.time_limit is None:
+            return None
+        return max(self.time_limit - self.elapsed, 0.0)
+
+    @property
+    def remaining_queries(self):
+        if self.queries_limit is None:
+            return None
+        return max(self.queries_limit - self.queries, 0)
+
+    @property
+    def remaining_rows(self):
+        if self.rows_limit is None:
+            return None
+        return max(self.rows_limit - self.rows, 0)
+
+    def split(self, parts):
+        """
+        Divide the remaining queries and rows between independent parts
+        of a search (e.g. directions), so the first part can't exhaust
+        the whole budget. Time isn't divided, parts are searched
+        interleaved (level by level).
+
+        Args:
+            parts (int): number of parts.
+
+        Returns:
+            list of SearchBudget: started budgets charging this one.
+
+        >>> budget = SearchBudget(queries_limit=10)
+        >>> first, second = budget.split(2)
+        >>> first.queries_limit, second.queries_limit
+        (5, 5)
+        >>> for _ in range(5):
+        ...     first.charge()
+        >>> first.check()
+        Traceback (most recent call last):
+        qas.graph.SearchBudgetExhausted: queries
+        >>> second.check(), budget.queries
+        (None, 5)
+        """
+        self.start()
+
+        def share(remaining):
+            if remaining is None:
+                return None
+            return max(remaining // parts, 1)
+        budgets = []
+        for _ in range(parts):
+            budget = SearchBudget(time_limit=self.remaining_time,
+                                  queries_limit=share(self.remaining_queries),
+                                  rows_limit=share(self.remaining_rows),
+                                  parent=self)
+            budget.start()
+            budgets.append(budget)
+        return budgets
+
+    def check(self):
+        """
+        Check that the next query is affordable.
+
+        Raises:
+            SearchBudgetExhausted: in case of any exhausted resource.
+        """
+        if self.exhausted is None:
+            if self.time_limit is not None and \
+               self.elapsed >= self.time_limit:
+                self.exhausted = "time"
+            elif self.queries_limit is not None and \
+                    self.queries >= self.queries_limit:
+                self.exhausted = "queries"
+            elif self.rows_limit is not None and \
+                    self.rows >= self.rows_limit:
+                self.exhausted = "rows"
+        if self.exhausted is None and self.parent is not None:
+            try:
+                self.parent.check()
+            except SearchBudgetExhausted:
+                self.exhausted = self.parent.exhausted
+        if self.exhausted is not None:
+            raise SearchBudgetExhausted(self.exhausted)
+
+    def charge(self, response=None):
+        """
+        Account one issued query and its result rows.
+
+        Args:
+            response (dict): SPARQL JSON response or None (no response).
+        """
+        self.queries += 1
+        if response is not None:
+            self.rows += len(response['results']['bindings'])
+        else:
+            self.failures += 1
+        if self.parent is not None:
+            self.parent.charge(response)
+
+    def query_timeout(self, default=DEFAULT_SPARQL_TIMEOUT):
+        """
+        Timeout for the next query, never exceeds the remaining time.
+        """
+        remaining = self.remaining_time
+        if remaining is None:
+            return default
+        return max(min(default, remaining), 0.1)
+
+    @property
+    def interrupted(self):
+        """
+        The search wasn't complete (exhausted budget or queries
+        without a response), its result may differ next time.
+        """
+        return self.exhausted is not None or self.failures > 0
+
+    def report(self):
+        return {
+            "elapsed": self.elapsed,
+            "queries": self.queries,
+            "rows": self.rows,
+            "failures": self.failures,
+            "exhausted": self.exhausted
+        }
+
+    def __str__(self):
+        result = "<BUDGET> {:.2f}s, {} queries, {} rows{}"
+        return result.format(
+            self.elapsed,
+            self.queries,
+            self.rows,
+            "" if self.exhausted is None else
+            " (exhausted: {})".format(self.exhausted))
+
 
 class Path(object):
     def __init__(self, path, config, item_from, item_to):
@@ -217,6 +415,23 @@ class Graph():
             # filter entities without assigned items (too filtered)
             if len(entity.items):
                 self.entities[label].append(entity)
+        # label -> (entities versions, items)
+        self._items = {}
+
+    def label_items(self, label):
+        """
+        Unique items of all entities with the label (cached tuple).
+        """
+        entities = self.entities[label]
+        versions = tuple(entity.version for entity in entities)
+        cached = self._items.get(label)
+        if cached is None or cached[0] != versions:
+            items = unique_items(item
+                                 for entity in entities
+                                 for item in entity.items)
+            cached = (versions, items, )
+            self._items[label] = cached
+        return cached[1]
 
     def construct_query(self, config, item_from, item_to):
         length = len(config)
@@ -342,12 +557,8 @@ class Graph():
 
     def items_comb(self, direction):
         # create sets of items
-        set_from = []
-        for entity in self.entities[direction[0]]:
-            set_from += entity.items
-        set_to = []
-        for entity in self.entities[direction[1]]:
-            set_to += entity.items
+        set_from = self.label_items(direction[0])
+        set_to = self.label_items(direction[1])
         # for each possible direction between items
         return list(itertools.product(set_from, set_to))
 
@@ -368,63 +579,27 @@ class Graph():
     def path_comb(self, direction, path_length):
         return zip(self.items_comb(direction), self.dir_comb(path_length))
 
-    def connect(self, *labels, interrupt="first"):
-
-        print("==== CONNECTION OVER GRAPH ====")
-
-        # directions of search
-        # for a basic example: [['question', 'answer']]
-        directions = [list(pair)
-                      for pair in itertools.combinations(labels, 2)]
-
-        # dictionary for final solutions
-        # frozenset is a key, path is a value
-        self.solutions = {}
-
-        timeout = None
-        # for path length until maximum
-        path_length_at_times = []
-        for path_length in range(1, MAX_PATH_LENGTH):
-            # save processing time measure
-            path_length_at_times.append(time.time())
-
-            if timeout is not None:
-                timeout = (timeout + 5.0) ** 2
-
-            # optimization step, async SPARQL querying
-            if not DISABLE_PARALLEL:
-                sparql_queries = []
-                for direction in directions:
-                    if self.skip_direction(path_length, direction):
-                        continue
-                    for (item_from, item_to), link_config in \
-                            self.path_comb(direction, path_length):
-                        query = self.construct_query(link_config,
-                                                     item_from,
-                                                     item_to)
-                        sparql_queries.append(query)
-                print("Timeout for path length", path_length, ":", timeout)
-                sparql_responses, timeout = Wikidata.sparql_parallel(
-                    sparql_queries,
-                    timeout=timeout)
-                print("Elapsed at path length", path_length, ":", timeout)
-            else:
-                # print("parallel querying is disabled")
-                sparql_responses, timeout = {}, None
-
-            # for direction between labels (question -> answer)
-            for direction in directions:
-                print("Length: {}, Labels: {} -> {}:".format(
-                    path_length, direction[0], direction[1]))
-
-                if self.skip_direction(path_length, direction):
-                    continue
+    def connect_at_length(self, path_length, directions,
+                          sparql_responses, budgets):
+        # for direction between labels (question -> answer)
+        for direction in directions:
+            print("Length: {}, Labels: {} -> {}:".format(
+                path_length, direction[0], direction[1]))
 
-                pathes_at_length = []
+            if self.skip_direction(path_length, direction):
+                continue
+            # each direction has its own share of the budget
+            budget = budgets[tuple(direction)]
+            if budget.exhausted is not None:
+                continue
 
+            pathes_at_length = []
+            try:
                 for (item_from, item_to), link_config in \
                         self.path_comb(direction, path_length):
-                    query = self.construct_query(link_config, item_from, item_to)
+                    query = self.construct_query(link_config,
+                                                 item_from,
+                                                 item_to)
                     response = None
                     # use preloaded parallel results
                     if query in sparql_responses:
@@ -432,7 +607,7 @@ class Graph():
                         if response is None:
                             if RETRY_PARALLEL_SPARQL or DISABLE_PARALLEL:
                                 try:
-                                    response = Wikidata.sparql(query)
+                                    response = self.sparql(query, budget)
                                 except NoSPARQLResponse:
                                     print("RTRETIME @",
                                           self.pp_link_config(link_config))
@@ -443,7 +618,7 @@ class Graph():
                                 continue
                     else:
                         try:
-                            response = Wikidata.sparql(query)
+                            response = self.sparql(query, budget)
                         except NoSPARQLResponse:
                             print("TIMEOUT @",
                                   self.pp_link_config(link_config))
@@ -465,17 +640,131 @@ class Graph():
                         print("[ ... {} paths found ... ]".format(
                             len(pathes)))
                     pathes_at_length += pathes
+            except SearchBudgetExhausted as exception:
+                print("BUDGET EXHAUSTED ({}) @ {} -> {}".format(
+                    exception.reason, direction[0], direction[1]))
+            finally:
+                # keep paths found before the interruption
                 if len(pathes_at_length):
                     if frozenset(direction) in self.solutions:
-                        self.solutions[frozenset(direction)] += pathes_at_length
+                        self.solutions[frozenset(direction)] += \
+                            pathes_at_length
                     else:
-                        self.solutions[frozenset(direction)] = pathes_at_length
+                        self.solutions[frozenset(direction)] = \
+                            pathes_at_length
+
+    @staticmethod
+    def sparql(query, budget):
+        """
+        Budgeted SPARQL query.
+
+        Raises:
+            SearchBudgetExhausted: no resources for the query.
+            NoSPARQLResponse: query failed or timed out.
+        """
+        budget.check()
+        try:
+            response = Wikidata.sparql(query,
+                                       timeout=budget.query_timeout())
+        except NoSPARQLResponse:
+            budget.charge()
+            raise
+        budget.charge(response)
+        return response
+
+    def connect(self, *labels, interrupt="first", budget=None):
+        """
+        Search paths between labeled entities.
+
+        The search is interrupted when the budget is exhausted,
+        solutions found so far are returned in that case. For more
+        than two labels each direction gets an equal share of queries
+        and rows (SearchBudget.split).
+
+        Args:
+            *labels (str): labels of entities to connect.
+            budget (SearchBudget): search limits, accounting is
+                available as .budget after the call.
+
+        Returns:
+            dict: frozenset of labels -> list of Path objects.
+        """
+
+        print("==== CONNECTION OVER GRAPH ====")
+
+        if budget is None:
+            budget = SearchBudget()
+        self.budget = budget
+        budget.start()
+
+        # directions of search
+        # for a basic example: [['question', 'answer']]
+        directions = [list(pair)
+                      for pair in itertools.combinations(labels, 2)]
+        if len(directions) > 1:
+            budgets = dict(zip([tuple(direction) for direction in directions],
+                               budget.split(len(directions))))
+        else:
+            budgets = {tuple(direction): budget for direction in directions}
+
+        # dictionary for final solutions
+        # frozenset is a key, path is a value
+        self.solutions = {}
+
+        timeout = None
+        # for path length until maximum
+        path_length_at_times = []
+        for path_length in range(1, MAX_PATH_LENGTH):
+            # save processing time measure
+            path_length_at_times.append(time.time())
+
+            if timeout is not None:
+                timeout = (timeout + 5.0) ** 2
+
+            # optimization step, async SPARQL querying
+            if not DISABLE_PARALLEL:
+                sparql_queries = []
+                for direction in directions:
+                    if self.skip_direction(path_length, direction):
+                        continue
+                    for (item_from, item_to), link_config in \
+                            self.path_comb(direction, path_length):
+                        query = self.construct_query(link_config,
+                                                     item_from,
+                                                     item_to)
+                        sparql_queries.append(query)
+                # never send more queries than affordable
+                if budget.remaining_queries is not None:
+                    sparql_queries = \
+                        sparql_queries[:budget.remaining_queries]
+                if timeout is not None:
+                    timeout = budget.query_timeout(timeout)
+                print("Timeout for path length", path_length, ":", timeout)
+                sparql_responses, timeout = Wikidata.sparql_parallel(
+                    sparql_queries,
+                    timeout=timeout)
+                for query in sparql_queries:
+                    budget.charge(sparql_responses.get(query))
+                print("Elapsed at path length", path_length, ":", timeout)
+            else:
+                # print("parallel querying is disabled")
+                sparql_responses, timeout = {}, None
+
+            self.connect_at_length(path_length,
+                                   directions,
+                                   sparql_responses,
+                                   budgets)
+            if all(direction_budget.exhausted is not None
+                   for direction_budget in budgets.values()):
+                print("BUDGET EXHAUSTED @ length {}".format(path_length))
+                break
         # print processing time info
         path_length_at_times.append(time.time())
         print("-" * 20)
         for idx, timestamp in list(enumerate(path_length_at_times))[1:]:
             processing_time = timestamp - path_length_at_times[idx-1]
             print('TIME AT LENGTH {}: {:.4f}'.format(idx, processing_time, ))
+        print(budget)
 
         for direction, pathes in self.solutions.items():
             # print(direction)
@@ -497,6 +786,218 @@ class Graph():
         # res = Wikidata.sparql(query)
         # print(res)
 
+    @staticmethod
+    def neighborhood_query(nodes):
+        """
+        Links of the nodes, each node is limited by its own subquery,
+        so a hub node can't take the links of the others.
+        """
+        subquery = """
+            {{ SELECT ?node ?prop ?neighbor ?reverse WHERE {{
+                VALUES ?node {{ wd:{} }}
+                {{ ?node ?prop ?neighbor . BIND(0 AS ?reverse) }}
+                UNION
+                {{ ?neighbor ?prop ?node . BIND(1 AS ?reverse) }}
+                FILTER ( strstarts(str(?prop),
+                                   "http://www.wikidata.org/prop/direct/") )
+                FILTER ( strstarts(str(?neighbor),
+                                   "http://www.wikidata.org/entity/Q") )
+            }} LIMIT {} }}"""
+        query = """
+        SELECT ?node ?prop ?neighbor ?reverse WHERE {{{}
+        }}
+        """
+        return query.format("\n            UNION".join(
+            subquery.format(node, NEIGHBORHOOD_LIMIT) for node in nodes))
+
+    def expand_neighborhoods(self, nodes, budget):
+        """
+        Query neighbors of all nodes at once (in batches).
+
+        Args:
+            nodes (list): item ids to expand.
+            budget (SearchBudget): search limits.
+
+        Returns:
+            dict: item id -> list of (property, direction, neighbor).
+        """
+        neighborhoods = {}
+        for offset in range(0, len(nodes), NEIGHBORHOOD_BATCH):
+            batch = nodes[offset:offset + NEIGHBORHOOD_BATCH]
+            try:
+                response = self.sparql(self.neighborhood_query(batch),
+                                       budget)
+            except NoSPARQLResponse:
+                print("TIMEOUT @ neighborhood of", len(batch), "nodes")
+                continue
+            for result in response['results']['bindings']:
+                node = result['node']['value'].split('/')[-1]
+                prop = result['prop']['value'].split('/')[-1]
+                neighbor = result['neighbor']['value'].split('/')[-1]
+                direction = int(result['reverse']['value'])
+                if node not in neighborhoods:
+                    neighborhoods[node] = []
+                neighborhoods[node].append((prop, direction, neighbor, ))
+        return neighborhoods
+
+    @staticmethod
+    def join_routes(route_from, route_to):
+        """
+        Join two routes reaching the same node into a Path.
+
+        Route is a pair of an origin item and a tuple of hops,
+        hop is (property, direction, reached node).
+        """
+        item_from, hops_from = route_from
+        item_to, hops_to = route_to
+        # walk back from the shared node to the second origin
+        nodes_to = [hop[2] for hop in hops_to[:-1]]
+        nodes_to.insert(0, item_to.wd_item_id)
+        hops_back = [(prop, 1 - direction, node)
+                     for (prop, direction, _), node
+                     in zip(reversed(hops_to), reversed(nodes_to))]
+        hops = list(hops_from) + hops_back
+        path = []
+        for idx, (prop, _, node) in enumerate(hops):
+            path.append(prop)
+            if idx != len(hops) - 1:
+                path.append(node)
+        config = tuple(direction for _, direction, _ in hops)
+        return Path(path, config, item_from, item_to)
+
+    def connect_terminals(self, *labels, budget=None):
+        """
+        Joint multi-terminal search.
+
+        Neighborhoods of all labeled entities are expanded once per
+        depth (shared nodes are queried once for all labels) and paths
+        are produced where routes from different labels meet. Nodes
+        reached from all labels (for 3+ labels) are saved as
+        .steiner_nodes, they connect whole question together.
+
+        Only direct (wdt:) links are followed, paths through statements
+        and qualifiers are found by Graph.connect.
+
+        Args:
+            *labels (str): labels of entities to connect.
+            budget (SearchBudget): search limits.
+
+        Returns:
+            dict: frozenset of two labels -> list of Path objects
+            (same format as Graph.connect).
+        """
+        print("==== JOINT CONNECTION OVER GRAPH ====")
+
+        if budget is None:
+            budget = SearchBudget()
+        self.budget = budget
+        budget.start()
+
+        self.solutions = {}
+        self.steiner_nodes = {}
+        labels = [label for label in labels if label in self.entities]
+        if len(labels) < 2:
+            return self.solutions
+
+        # node -> label -> list of routes
+        reached = {}
+        terminals = set()
+        frontier = {}
+        for label in labels:
+            frontier[label] = []
+            for item in self.label_items(label):
+                node = item.wd_item_id
+                terminals.add(node)
+                routes = reached.setdefault(node, {}).setdefault(label, [])
+                if len(routes) == 0:
+                    frontier[label].append(node)
+                routes.append((item, (), ))
+
+        found = set()
+
+        def meet(node, label):
+            # combine new routes with routes of other labels
+            for other, other_routes in reached[node].items():
+                if other == label:
+                    continue
+                if labels.index(label) < labels.index(other):
+                    first, second = label, other
+                else:
+                    first, second = other, label
+                for route_from in reached[node][first]:
+                    for route_to in reached[node][second]:
+                        length = len(route_from[1]) + len(route_to[1])
+                        if length == 0 or length >= MAX_PATH_LENGTH:
+                            continue
+                        path = self.join_routes(route_from, route_to)
+                        key = (path.item_from.wd_item_id,
+                               path.item_to.wd_item_id,
+                               tuple(path.path),
+                               path.config)
+                        if key in found:
+                            continue
+                        found.add(key)
+                        if len(self.filter_pathes([path])) == 0:
+                            continue
+                        print("SUCCESS @", first, second, path)
+                        self.solutions.setdefault(
+                            frozenset((first, second, )), []).append(path)
+            if len(labels) > 2 and node not in terminals and \
+               len(reached[node]) == len(labels):
+                self.steiner_nodes[node] = set(reached[node])
+
+        for node in list(reached):
+            for label in list(reached[node]):
+                meet(node, label)
+
+        # each side walks half of the maximal path length
+        max_depth = MAX_PATH_LENGTH // 2
+        try:
+            for depth in range(1, max_depth + 1):
+                nodes = []
+                for label in labels:
+                    nodes += frontier[label]
+                nodes = sorted(set(nodes))
+                print("Depth: {}, expanding {} nodes".format(depth,
+                                                            len(nodes)))
+                if len(nodes) == 0:
+                    break
+                neighborhoods = self.expand_neighborhoods(nodes, budget)
+                # ordered sets of newly reached nodes
+                new_frontier = {label: {} for label in labels}
+                for label in labels:
+                    for node in frontier[label]:
+                        routes = reached[node][label]
+                        for prop, direction, neighbor in \
+                                neighborhoods.get(node, []):
+                            labeled = reached.setdefault(neighbor, {})
+                            if label in labeled and \
+                               neighbor not in new_frontier[label]:
+                                continue  # reached at lower depth
+                            if label not in labeled:
+                                labeled[label] = []
+                                new_frontier[label][neighbor] = None
+                            for item, hops in routes:
+                                if len(labeled[label]) >= \
+                                   MAX_ROUTES_PER_NODE:
+                                    break
+                                labeled[label].append(
+                                    (item,
+                                     hops + ((prop, direction, neighbor, ), ),
+                                     ))
+                for label in labels:
+                    for node in new_frontier[label]:
+                        meet(node, label)
+                frontier = {label: list(nodes)
+                            for label, nodes in new_frontier.items()}
+        except SearchBudgetExhausted as exception:
+            print("BUDGET EXHAUSTED ({})".format(exception.reason))
+        print(budget)
+
+        if len(self.steiner_nodes):
+            print("Steiner nodes:", ", ".join(sorted(self.steiner_nodes)))
+        return self.solutions
+
     @staticmethod
     def evaluate_solutions(solutions):
         k = 3
@@ -2,32 +2,144 @@
 Entities of a dataset classes.
 """
 
+import sys
+import weakref
+
 from qas.wikidata import Wikidata, WikidataItemsNotFound
+from qas.label_index import normalize_label
 
 STRICT_NAME = False  # filter not same Wikidata
 PRIMARY_COUNT = 1
 RETRY_PARALLEL_MATCHING = False
 
-
-def matching_parallel(indexed_noun_phrases, disable_wordnet=False):
+# offline label index (qas.label_index.LabelIndex),
+# Wikidata API is used if not specified
+LABEL_INDEX = None
+# single fuzzy search per noun phrase (without permutations)
+FUZZY_LINKING = False
+# filter of known labels (qas.bloom.BloomFilter)
+LABEL_FILTER = None
+
+
+def use_label_index(label_index, fuzzy=False):
+    """
+    Link entities using the offline label index instead of the API.
+
+    Args:
+        label_index (qas.label_index.LabelIndex): index or None.
+        fuzzy (bool): index is qas.fuzzy_index.FuzzyIndex, search
+            noun phrases without permutations.
+    """
+    global LABEL_INDEX, FUZZY_LINKING
+    LABEL_INDEX = label_index
+    FUZZY_LINKING = fuzzy
+
+
+def use_label_filter(label_filter):
+    """
+    Skip searches for texts, which are not known labels.
+
+    Args:
+        label_filter (qas.bloom.BloomFilter): filter or None.
+    """
+    global LABEL_FILTER
+    LABEL_FILTER = label_filter
+
+
+def search_by_label(text):
+    """
+    Search items by label (offline index or Wikidata API).
+
+    Raises:
+        WikidataItemsNotFound: nothing was found.
+    """
+    if LABEL_INDEX is None:
+        return Wikidata.search_by_label(text)
+    results = LABEL_INDEX.search(text)
+    if results is None:
+        raise WikidataItemsNotFound()
+    return results
+
+
+def search_by_label_parallel(queries, failed=None):
+    if LABEL_INDEX is None:
+        return Wikidata.search_by_label_parallel(queries, failed=failed)
+    return LABEL_INDEX.search_many(queries)
+
+
+def matching_parallel(indexed_noun_phrases, disable_wordnet=False,
+                      limit=None, failed=None):
+    """
+    Link all noun phrases in a single parallel batch.
+
+    Searched texts are normalized and deduplicated over all phrases.
+    Permutations are generated per noun phrase, they hold its own tokens
+    (template slots are matched by token positions).
+
+    Args:
+        indexed_noun_phrases (list): (index, noun phrase) pairs
+            (possibly from several sentences).
+        disable_wordnet (bool): skip synonymic permutations.
+        limit (int): maximal permutations count per noun phrase.
+        failed (set): normalized texts, which searches failed
+            (e.g. timed out), are added to the set.
+
+    Returns:
+        list, dict: (index, noun phrase, permutations) tuples and
+            normalized text -> search results (or None).
+    """
     # optimization step
     # parallel enitites linking
     # building paired permutation initially
     permuted_noun_phrases = []
-    matching_queries = []
+    matching_queries = {}
     for idx, noun_phrase in indexed_noun_phrases:
-        permutations = noun_phrase.get_permutations(
-            disable_wordnet=disable_wordnet)
+        if FUZZY_LINKING:
+            # fuzzy search covers structural and synonymic variants
+            permutations = [noun_phrase]
+        else:
+            # only the most promising permutations are searched
+            permutations = noun_phrase.get_permutations(
+                disable_wordnet=disable_wordnet,
+                limit=limit)
         permuted_noun_phrases.append((idx, noun_phrase, permutations, ))
         for permutation in permutations:
-            matching_queries.append(permutation.text)
+            matching_queries[normalize_label(permutation.text)] = None
+    queries = list(matching_queries)
+    if LABEL_FILTER is not None:
+        # drop permutations, which can't match any label
+        queries = [query for query in queries if query in LABEL_FILTER]
     # parallel linking step
-    matching = Wikidata.search_by_label_parallel(matching_queries)
+    matching = search_by_label_parallel(queries, failed=failed)
+    for query in matching_queries:
+        if query not in matching:
+            matching[query] = None
+    if LABEL_FILTER is not None:
+        # learn labels missing in the filter source
+        for results in matching.values():
+            if results is not None:
+                LABEL_FILTER.add_search_results(results)
     return permuted_noun_phrases, matching
 
 
+def unique_items(items):
+    """
+    Deduplicate items, keeping the order of the first occurrence.
+
+    Args:
+        items (iterable): items to deduplicate.
+
+    Returns:
+        tuple: unique items.
+
+    >>> unique_items(["Q2", "Q1", "Q2", "Q3", "Q1"])
+    ('Q2', 'Q1', 'Q3')
+    """
+    return tuple(dict.fromkeys(items))
+
+
 class Item():
-    pass
+    __slots__ = ()
 
 
 class NoEnglishLabelAvailable(Exception):
@@ -35,22 +147,41 @@ class NoEnglishLabelAvailable(Exception):
 
 
 class WikidataItem(Item):
-    def __init__(self, item_id, label=None, description=None, claims={}):
-        self.item_id = item_id
-        self.label = label
-        self.description = description
-        self.claims = claims
+    """
+    Wikidata item.
+
+    Items are interned: the same item id always resolves to one shared
+    object while it is referenced (per-process registry). Data passed
+    for an already known item fills missing fields of the shared one.
+    """
+    __slots__ = ('item_id', 'label', 'description', 'claims', '__weakref__')
+
+    registry = weakref.WeakValueDictionary()
+
+    def __new__(cls, item_id, label=None, description=None, claims=None):
+        item = cls.registry.get(item_id)
+        if item is None:
+            item = super(WikidataItem, cls).__new__(cls)
+            item.item_id = sys.intern(item_id)
+            item.label = None
+            item.description = None
+            item.claims = {}
+            cls.registry[item.item_id] = item
+        return item
+
+    def __init__(self, item_id, label=None, description=None, claims=None):
+        if self.label is None:
+            self.label = label
+        if self.description is None:
+            self.description = description
+        if claims is not None:
+            self.claims = claims
 
     @classmethod
     def from_search_result(cls, data):
-        item_id = data['id']
-        label = None
-        if 'label' in data:
-            label = data['label']
-        description = None
-        if 'description' in data:
-            description = data['description']
-        return cls(item_id, label=label, description=description)
+        return cls(data['id'],
+                   label=data.get('label'),
+                   description=data.get('description'))
 
     @classmethod
     def from_get_result(cls, data):
@@ -65,6 +196,7 @@ class WikidataItem(Item):
             description = data['description']['en']['value']
         except KeyError:
             pass
+        claims = None
         if 'claims' in data:
             claims = Wikidata.extract_claims(data)
         # print(item_id, label, claims)
@@ -81,15 +213,25 @@ class WikidataItem(Item):
 
 
 class UniversalItem():
+    """
+    Item linked with the knowledge bases (interned by Wikidata item id).
+    """
+    __slots__ = ('wikidata_item', 'dbpedia_item', '__weakref__')
+
+    registry = weakref.WeakValueDictionary()
+
     def __init__(self, wikidata_item, dbpedia_item):
         self.wikidata_item = wikidata_item
         self.dbpedia_item = dbpedia_item
-        self.primary = False
 
     @classmethod
     def from_wikidata_item(cls, wikidata_item):
-        dbpedia_item = None
-        return cls(wikidata_item, dbpedia_item)
+        item = cls.registry.get(wikidata_item.item_id)
+        if item is None:
+            dbpedia_item = None
+            item = cls(wikidata_item, dbpedia_item)
+            cls.registry[wikidata_item.item_id] = item
+        return item
 
     @property
     def label(self):
@@ -109,6 +251,8 @@ class UniversalItem():
             "https://www.wikidata.org/wiki/{} ".format(str(self.wikidata_item)))
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if self.wikidata_item is not None and other.wikidata_item is not None:
             if self.wikidata_item.item_id == other.wikidata_item.item_id:
                 return True
@@ -124,60 +268,105 @@ class EmptyItemsBatch(Exception):
 
 
 class ItemsBatch(object):
-    def __init__(self, noun_phrase, matching={}):
+    """
+    Items found for a noun phrase (permutation).
+
+    Search results are kept as compact (item id, label, description)
+    tuples, item objects are created only when .batch is used.
+    Strictification narrows the view without rebuilding anything.
+    """
+    def __init__(self, noun_phrase, matching=None, raw=None, view=None):
         self.noun_phrase = noun_phrase
-        wikidata_results = []
+        # indexes of visible raw results (None - all of them)
+        self.view = None if view is None else tuple(view)
+        self._batch = None
+        if raw is not None:
+            # restored batch (see .dump)
+            self.raw = tuple(tuple(result) for result in raw)
+            if len(self.raw) == 0:
+                raise EmptyItemsBatch()
+            return
+        if matching is None:
+            matching = {}
+        query = normalize_label(noun_phrase.text)
+        results = []
         try:
-            results = None
-            if noun_phrase.text in matching:
-                results = matching[noun_phrase.text]
+            if query in matching:
+                results = matching[query]
                 if results is None:
                     if RETRY_PARALLEL_MATCHING:
-                        results = Wikidata.search_by_label(noun_phrase.text)
+                        results = search_by_label(query)
                     else:
                         raise WikidataItemsNotFound()
             else:
-                results = Wikidata.search_by_label(noun_phrase.text)
-            for result in results:
-                wikidata_item = WikidataItem.from_search_result(result)
-                wikidata_results.append(wikidata_item)
+                results = search_by_label(query)
         except WikidataItemsNotFound:
             # print("WikidataItemsNotFound ", noun_phrase)
-            pass
-        # DBpedia items
-        self.batch = []
-        for item in wikidata_results:
-            self.batch.append(UniversalItem.from_wikidata_item(item))
-        if len(self.batch) == 0:
+            results = []
+        self.raw = tuple((sys.intern(result['id']),
+                          result.get('label'),
+                          result.get('description'), )
+                         for result in results)
+        if len(self.raw) == 0:
             raise EmptyItemsBatch()
-        for i in range(PRIMARY_COUNT):
-            try:
-                self.batch[i].primary = True
-            except IndexError:
-                break
-        # self.strict = []
-        # self.strict_filter()
-        # self.super_strict()
 
-    def strict_filter(self):
+    @property
+    def indexes(self):
+        if self.view is None:
+            return range(len(self.raw))
+        return self.view
+
+    @property
+    def item_ids(self):
+        return tuple(self.raw[idx][0] for idx in self.indexes)
+
+    @property
+    def batch(self):
+        """
+        Visible items (materialized on the first access).
+        """
+        if self._batch is None:
+            self._batch = []
+            for idx in self.indexes:
+                item_id, label, description = self.raw[idx]
+                wikidata_item = WikidataItem(item_id,
+                                             label=label,
+                                             description=description)
+                self._batch.append(
+                    UniversalItem.from_wikidata_item(wikidata_item))
+        return self._batch
+
+    def strict_filter(self, indexes):
         strict = []
-        for item in self.batch:
-            if item.wikidata_item.label is None:
+        text = self.noun_phrase.text.lower()
+        for idx in indexes:
+            label = self.raw[idx][1]
+            if label is None:
                 continue
-            if item.wikidata_item.label.lower() == \
-               self.noun_phrase.text.lower():
-                strict.append(item)
+            if label.lower() == text:
+                strict.append(idx)
         return strict
 
     @staticmethod
-    def super_strict(batch):
-        return [item for item in batch if item.primary]
+    def super_strict(indexes):
+        return [idx for idx in indexes if idx < PRIMARY_COUNT]
 
     def strictify(self):
-        # print("called on", self.noun_phrase.text, [str(x) for x in self.batch])
+        # print("called on", self.noun_phrase.text, self.item_ids)
+        indexes = self.indexes
         if STRICT_NAME:
-            self.batch = self.strict_filter()
-        self.batch = self.super_strict(self.batch)
+            indexes = self.strict_filter(indexes)
+        self.view = tuple(self.super_strict(indexes))
+        self._batch = None
+
+    def dump(self):
+        """
+        Serializable representation of the batch.
+
+        Returns:
+            tuple: permutation text, raw results, view.
+        """
+        return self.noun_phrase.text, self.raw, self.view
 
     def __str__(self):
         result = "<BATCH> {} ({})\n\t\t" + "{} " * len(self.batch)
@@ -193,12 +382,15 @@ class EmptyEntity(Exception):
 
 class Entity():
     def __init__(self, noun_phrase, permutations=None,
-                 matching=None, log=None):
+                 matching=None, log=None, candidates=None):
         self.log = log
         self.noun_phrase = noun_phrase
 
+        # restored entity, candidates are already known
+        if candidates is not None:
+            permutations = []
         # parse permutation in case of non-optimzied and non-parallel
-        if permutations is None:
+        elif permutations is None:
             permutations = noun_phrase.get_permutations()
 
         # # widget with permutations
@@ -206,7 +398,7 @@ class Entity():
         # for permutation in permutations:
         #     print("\t"+str(permutation))
 
-        self.candidates = []
+        self.candidates = [] if candidates is None else list(candidates)
         for permutation in permutations:
             try:
                 self.candidates.append(ItemsBatch(permutation,
@@ -217,17 +409,55 @@ class Entity():
         if len(self.candidates) == 0:
             raise EmptyEntity()
 
+        # cached items views, changed by strictify only
+        self.version = 0
+        self._items = None
+        self._item_ids = None
+
     @property
     def items(self):
-        result = []
-        for candidate in self.candidates:
-            for item in candidate.batch:
-                result.append(item)
-        return result
+        """
+        Unique items of all candidates (cached tuple).
+        """
+        if self._items is None:
+            self._items = unique_items(
+                item
+                for candidate in self.candidates
+                for item in candidate.batch)
+        return self._items
+
+    @property
+    def item_ids(self):
+        """
+        Unique item ids of all candidates (without items creation).
+        """
+        if self._item_ids is None:
+            self._item_ids = unique_items(
+                item_id
+                for candidate in self.candidates
+                for item_id in candidate.item_ids)
+        return self._item_ids
 
     def strictify(self):
         for candidate in self.candidates:
             candidate.strictify()
+        # invalidate cached items views
+        self.version += 1
+        self._items = None
+        self._item_ids = None
+
+    def dump(self):
+        """
+        Serializable representation of the entity.
+
+        Returns:
+            dict: noun phrase tokens indexes and candidates.
+        """
+        return {
+            "tokens": [token.i for token in self.noun_phrase.tokens],
+            "candidates": [candidate.dump()
+                           for candidate in self.candidates]
+        }
 
     def __str__(self):
         result = "<ENTITY> {} ({})\n" + "\t{}\n" * len(self.candidates)
@@ -237,41 +467,173 @@ class Entity():
             *self.candidates)
 
 
+class ItemsEntity():
+    """
+    Entity with the fixed set of items, which can be sent to other
+    processes (graph search only uses items of entities).
+    """
+    __slots__ = ('items', 'version')
+
+    def __init__(self, raw):
+        self.items = unique_items(
+            UniversalItem.from_wikidata_item(
+                WikidataItem(item_id, label=label, description=description))
+            for item_id, label, description in raw)
+        self.version = 0
+
+    @staticmethod
+    def dump(entity):
+        """
+        Serializable items of an entity.
+
+        Returns:
+            list: (item id, label, description) tuples.
+        """
+        return [(item.wd_item_id,
+                 item.wikidata_item.label,
+                 item.wikidata_item.description, )
+                for item in entity.items]
+
+
 class EntitySet():
     def __init__(self, entities, log=None):
         self.log = log
         self.set = entities
+        self._items = None
+        self._item_ids = None
+        self._versions = None
 
     @property
     def items(self):
-        result = []
-        for entity in self.set:
-            for item in entity.items:
-                result.append(item)
-        return result
+        """
+        Unique items of all entities (cached tuple).
+        Cache is rebuilt when any entity was strictified.
+
+        >>> from types import SimpleNamespace as Entity
+        >>> entity = Entity(items=("Q1", "Q2"), version=0)
+        >>> entities_set = EntitySet([entity,
+        ...                           Entity(items=("Q2", "Q3"), version=0)])
+        >>> entities_set.items
+        ('Q1', 'Q2', 'Q3')
+        >>> entity.items, entity.version = ("Q4", ), 1  # strictified
+        >>> entities_set.items
+        ('Q4', 'Q2', 'Q3')
+        """
+        self.check_versions()
+        if self._items is None:
+            self._items = unique_items(item
+                                       for entity in self.set
+                                       for item in entity.items)
+        return self._items
+
+    @property
+    def item_ids(self):
+        """
+        Unique item ids of all entities (cached tuple).
+        """
+        self.check_versions()
+        if self._item_ids is None:
+            self._item_ids = unique_items(item_id
+                                          for entity in self.set
+                                          for item_id in entity.item_ids)
+        return self._item_ids
+
+    def dump(self):
+        return [entity.dump() for entity in self.set]
+
+    def check_versions(self):
+        # drop cached views if any entity was strictified
+        versions = tuple(entity.version for entity in self.set)
+        if self._versions != versions:
+            self._items = None
+            self._item_ids = None
+            self._versions = versions
 
     @classmethod
     def merge(cls, entities_sets):
-        # for idx, entity_set in enumerate(entities_sets):
-        #     print(idx, [entity.noun_phrase.text for entity in entity_set.set])
-        for idx1, entity_set1 in enumerate(entities_sets):
-            for idx2, entity_set2 in enumerate(entities_sets):
-                if idx1 != idx2:
-                    intersection = set(entity_set1.items).intersection(entity_set2.items)
-                    for shared_item in intersection:
-                        entity_set1.log.debug("Merging two sets beacause of shared %s",
-                                              str(shared_item))
-                    if len(intersection):
-                        merged_entity_sets = [entity_set
-                                              for idx, entity_set in enumerate(entities_sets)
-                                              if idx not in [idx1, idx2]]
-                        merged_set = cls(entity_set1.set + entity_set2.set,
-                                         log=entity_set1.log)
-                        # print(merged_set)
-                        merged_entity_sets.append(merged_set)
-                        # print(merged_entity_sets)
-                        return cls.merge(merged_entity_sets)
-        return entities_sets
+        """
+        Merge entities sets, which share at least one item.
+
+        Union-find over the item to set index finds groups of sets to
+        merge in a single pass. Merges are then replayed in the order
+        of the recursive merge (the first set sharing an item is merged
+        with its first partner, the result goes to the end), so the
+        order of sets and of their entities stays the same.
+
+        Args:
+            entities_sets (list of EntitySet): initial sets.
+
+        Returns:
+            list of EntitySet: not merged sets (in the initial order)
+            followed by merged sets.
+
+        >>> from types import SimpleNamespace as Entity
+        >>> a, b, c, d = [Entity(name=name, item_ids=item_ids, version=0)
+        ...               for name, item_ids in [("a", ("Q1", )),
+        ...                                      ("b", ("Q2", )),
+        ...                                      ("c", ("Q1", "Q2")),
+        ...                                      ("d", ("Q3", ))]]
+        >>> [[entity.name for entity in entities_set.set]
+        ...  for entities_set in EntitySet.merge(
+        ...      [EntitySet([entity]) for entity in (a, b, c, d)])]
+        [['d'], ['b', 'a', 'c']]
+        """
+        parents = list(range(len(entities_sets)))
+
+        def find(idx):
+            while parents[idx] != idx:
+                parents[idx] = parents[parents[idx]]  # path halving
+                idx = parents[idx]
+            return idx
+
+        # item -> index of the first set with the item
+        owners = {}
+        for idx, entity_set in enumerate(entities_sets):
+            for item in entity_set.item_ids:
+                if item not in owners:
+                    owners[item] = idx
+                    continue
+                root1 = find(owners[item])
+                root2 = find(idx)
+                if root1 != root2:
+                    parents[max(root1, root2)] = min(root1, root2)
+
+        log = entities_sets[0].log if len(entities_sets) else None
+        # sets left in each group, every set of a group with more than
+        # one set shares an item with another set of the group
+        sizes = {}
+        for idx in range(len(entities_sets)):
+            sizes[find(idx)] = sizes.get(find(idx), 0) + 1
+        # (group, entities, item ids, initial set or None if merged)
+        current = [(find(idx),
+                    entity_set.set,
+                    set(entity_set.item_ids),
+                    entity_set, )
+                   for idx, entity_set in enumerate(entities_sets)]
+        while True:
+            first = next((position
+                          for position, (root, _, _, _) in enumerate(current)
+                          if sizes[root] > 1), None)
+            if first is None:
+                break
+            root, entities, item_ids, _ = current[first]
+            second = next(position
+                          for position in range(first + 1, len(current))
+                          if current[position][0] == root and
+                          not item_ids.isdisjoint(current[position][2]))
+            _, other_entities, other_item_ids, _ = current[second]
+            if log is not None:
+                for item in item_ids & other_item_ids:
+                    log.debug("Merging two sets because of shared %s", item)
+            del current[second]
+            del current[first]
+            current.append((root,
+                            entities + other_entities,
+                            item_ids | other_item_ids,
+                            None, ))
+            sizes[root] -= 1
+        return [cls(entities, log=log) if entity_set is None else entity_set
+                for _, entities, _, entity_set in current]
 
     def __str__(self):
         result = "<ENTITY_SET>\n" + "{}\n" * len(self.set)
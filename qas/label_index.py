@@ -0,0 +1,219 @@
+"""
+Offline label to Wikidata item index.
+
+Local replacement of the wbsearchentities API for entities linking.
+The index consists of two sorted string tables:
+
+    <prefix>.entities: item id -> sitelinks count, label, description
+    <prefix>.labels: normalized label or alias -> entity rows
+                     (ranked by sitelinks count)
+
+Usage:
+python3 -m qas.label_index latest-all.json.gz index
+"""
+
+import array
+import bz2
+import gzip
+import json
+import struct
+import sys
+import unicodedata
+
+from qas.sstable import Table, ExternalSort, external_sort, group_rows, \
+    write_table
+
+SEARCH_LIMIT = 20
+PREFIX_SCAN_LIMIT = 1000  # keys scanned for prefix matches
+SEPARATOR = b'\x1f'
+SITELINKS = struct.Struct('=I')
+
+
+def normalize_label(text):
+    """
+    Normalize label for the index lookup.
+
+    >>> normalize_label("  Heineken   Brewery ")
+    'heineken brewery'
+
+    Args:
+        text (str): label or searched text.
+
+    Returns:
+        str: normalized text.
+    """
+    text = unicodedata.normalize('NFKC', text)
+    return " ".join(text.lower().split())
+
+
+def open_dump(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rt', encoding='utf-8')
+    return open(filename, encoding='utf-8')
+
+
+def read_dump(filename, language="en"):
+    """
+    Read entities from the Wikidata JSON dump (one entity per line).
+
+    Yields:
+        tuple: item id, label, aliases, description, sitelinks count.
+    """
+    with open_dump(filename) as dump:
+        for line in dump:
+            line = line.strip().rstrip(',')
+            if line in ('[', ']', ''):
+                continue
+            data = json.loads(line)
+            if not data['id'].startswith('Q'):
+                continue
+            label = data.get('labels', {}).get(language, {}).get('value')
+            if label is None:
+                continue
+            aliases = [alias['value']
+                       for alias in data.get('aliases', {}).get(language, [])]
+            description = data.get('descriptions', {}) \
+                .get(language, {}).get('value')
+            yield (data['id'], label, aliases, description,
+                   len(data.get('sitelinks', {})))
+
+
+def build(records, prefix):
+    """
+    Build the index files.
+
+    Records are sorted externally and streamed to the tables, so the
+    whole dump never has to fit in memory.
+
+    >>> import os, shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> prefix = os.path.join(directory, 'index')
+    >>> build([("Q2", "Oslo", ["Christiania"], "capital of Norway", 200),
+    ...        ("Q1", "Oslo", [], None, 5),
+    ...        ("Q3", "Oslofjord", [], "inlet", 50)], prefix)
+    >>> index = LabelIndex(prefix)
+    >>> [result["id"] for result in index.search("oslo")]
+    ['Q2', 'Q1', 'Q3']
+    >>> index.search("Christiania")[0]["description"]
+    'capital of Norway'
+    >>> index.search("Bergen") is None
+    True
+    >>> index.close()
+    >>> shutil.rmtree(directory)
+
+    Args:
+        records (iterable): tuples of item id, label, aliases,
+            description and sitelinks count.
+        prefix (str): index files prefix.
+    """
+    entities = external_sort(
+        (item_id.encode('utf-8'),
+         SITELINKS.pack(sitelinks) +
+         label.encode('utf-8') + SEPARATOR +
+         (description or '').encode('utf-8'),
+         tuple(set(normalize_label(text) for text in [label] + list(aliases))),
+         sitelinks, )
+        for item_id, label, aliases, description, sitelinks in records)
+    # (label, -sitelinks, row): rows of a label ranked by sitelinks
+    postings = ExternalSort()
+
+    def entities_items():
+        for row, (key, value, texts, sitelinks) in enumerate(entities):
+            for text in texts:
+                postings.add((text.encode('utf-8'), -sitelinks, row, ))
+            yield key, value
+    write_table(prefix + '.entities', entities_items(), presorted=True)
+    write_table(prefix + '.labels', group_rows(postings), presorted=True)
+
+
+class LabelIndex(object):
+    """
+    Memory-mapped label index.
+    """
+    def __init__(self, prefix):
+        self.entities = Table(prefix + '.entities')
+        self.labels = Table(prefix + '.labels')
+
+    def entity(self, row):
+        """
+        Search result for an entity row (wbsearchentities format).
+        """
+        value = self.entities.value(row)
+        sitelinks, = SITELINKS.unpack_from(value, 0)
+        label, description = value[SITELINKS.size:].split(SEPARATOR, 1)
+        result = {
+            "id": self.entities.key(row).decode('utf-8'),
+            "label": label.decode('utf-8'),
+            "sitelinks": sitelinks
+        }
+        if len(description):
+            result["description"] = description.decode('utf-8')
+        return result
+
+    def rows(self, idx):
+        return array.array('I', self.labels.value(idx))
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Search items by label or alias.
+        Exact matches go first, prefix matches are ranked by sitelinks.
+
+        Args:
+            query (str): searched text.
+            limit (int): maximal results count.
+
+        Returns:
+            list of dict: search results (id, label, description)
+            or None if nothing was found.
+        """
+        key = normalize_label(query).encode('utf-8')
+        if len(key) == 0:
+            return None
+        result_rows = []
+        exact = self.labels.find(key)
+        if exact is not None:
+            result_rows += self.rows(exact)[:limit]
+        if len(result_rows) < limit:
+            prefixed = []
+            for count, idx in enumerate(self.labels.prefix(key)):
+                if count == PREFIX_SCAN_LIMIT:
+                    break
+                if idx != exact:
+                    prefixed += self.rows(idx)
+            prefixed = sorted(set(prefixed) - set(result_rows),
+                              key=self.sitelinks,
+                              reverse=True)
+            result_rows += prefixed[:limit - len(result_rows)]
+        if len(result_rows) == 0:
+            return None
+        return [self.entity(row) for row in result_rows]
+
+    def sitelinks(self, row):
+        return SITELINKS.unpack_from(self.entities.value(row), 0)[0]
+
+    def search_many(self, queries, limit=SEARCH_LIMIT):
+        """
+        Search for several queries at once.
+
+        Returns:
+            dict: query -> search results or None
+            (same format as Wikidata.search_by_label_parallel).
+        """
+        return {query: self.search(query, limit=limit)
+                for query in queries}
+
+    def close(self):
+        self.entities.close()
+        self.labels.close()
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.exit("Usage: python3 -m qas.label_index DUMP INDEX_PREFIX")
+    build(read_dump(sys.argv[1]), sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Lazy imports of heavy modules and startup timings.
+
+Modules are imported on the first attribute access, so the command
+line interface starts without spaCy, NLTK, langdetect, gevent and
+requests. Load time of every component is recorded in TIMINGS.
+"""
+
+import collections
+import contextlib
+import importlib
+import threading
+import time
+import types
+
+# component name -> load time (seconds), in the loading order
+TIMINGS = collections.OrderedDict()
+SSL_PATCHED = False
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Record load time of a component.
+    """
+    started = time.time()
+    yield
+    TIMINGS[name] = TIMINGS.get(name, 0.0) + time.time() - started
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module proxy, the module is imported on the first attribute access.
+
+    Attributes:
+        setup (callable): called once before the import (e.g. patches).
+    """
+    def __init__(self, name, setup=None):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def __load(self):
+        # private (mangled) name, "load" is an attribute of spaCy
+        module = self.__dict__['_module']
+        if module is None:
+            # the module may be loaded by warm-up threads
+            with self.__dict__['_lock']:
+                module = self.__dict__['_module']
+                if module is None:
+                    with timed(self.__name__):
+                        setup = self.__dict__['_setup']
+                        if setup is not None:
+                            setup()
+                        module = importlib.import_module(self.__name__)
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self.__load(), name)
+
+
+def patch_ssl():
+    """
+    gevent SSL patch before requests is imported (once).
+    detailed info:
+    https://github.com/kennethreitz/requests/issues/3752
+    Python 3.6.1 with grequests causes an error with full patching.
+    """
+    global SSL_PATCHED
+    if SSL_PATCHED:
+        return
+    SSL_PATCHED = True
+    with timed('gevent'):
+        from gevent import monkey
+
+        def stub(*args, **kwargs):  # pylint: disable=unused-argument
+            pass
+        monkey.patch_all = stub
+        monkey.patch_ssl()
+
+
+spacy = LazyModule('spacy', setup=patch_ssl)
+nltk_tokenize = LazyModule('nltk.tokenize', setup=patch_ssl)
+langdetect = LazyModule('langdetect')
+numpy = LazyModule('numpy')
+requests = LazyModule('requests', setup=patch_ssl)
+grequests = LazyModule('grequests', setup=patch_ssl)
+coloredlogs = LazyModule('coloredlogs')
@@ -7,7 +7,8 @@ Used for both regular logging and Websocket based UI reporting.
 """
 
 import logging
-import coloredlogs
+
+from qas.lazy import coloredlogs
 
 logging.getLogger('requests').setLevel(logging.CRITICAL)
 
@@ -2,15 +2,46 @@
 Noun phrases and permutations.
 """
 
-import spacy
-from nltk.corpus import wordnet
+from qas.lazy import spacy
 
 import itertools
+import functools
+import heapq
+import difflib
 
 MAX_STRUCT_PERMUTATIONS = 50
+SYNONYM_WEIGHT = 0.9  # synonym is always worse than the original word
+
+# precomputed synonyms (qas.synonyms.SynonymTable),
+# WordNet corpus is used if not specified
+SYNONYM_TABLE = None
+SYNONYMS_CACHE_SIZE = 100000
+
+
+def use_synonym_table(synonym_table):
+    """
+    Use precomputed synonyms table instead of the WordNet corpus.
+
+    Args:
+        synonym_table (qas.synonyms.SynonymTable): table or None.
+    """
+    global SYNONYM_TABLE
+    SYNONYM_TABLE = synonym_table
+    cached_synonyms.cache_clear()
 
 
 def get_synonyms(word, pos=None):
+    return list(cached_synonyms(word, pos))
+
+
+@functools.lru_cache(maxsize=SYNONYMS_CACHE_SIZE)
+def cached_synonyms(word, pos=None):
+    """
+    Process-wide cached synonyms (in the WordNet order).
+    """
+    if SYNONYM_TABLE is not None:
+        return tuple(SYNONYM_TABLE.synonyms(word, pos=pos))
+    from nltk.corpus import wordnet
     wordnet_pos = {
         "NOUN": wordnet.NOUN,
         "VERB": wordnet.VERB,
@@ -25,9 +56,9 @@ def get_synonyms(word, pos=None):
     for synset in synsets:
         synonyms += [str(lemma.name()) for lemma in synset.lemmas()]
     synonyms = [synonym.replace("_", " ") for synonym in synonyms]
-    synonyms = list(set(synonyms))
+    synonyms = list(dict.fromkeys(synonyms))
     synonyms = [synonym for synonym in synonyms if synonym != word]
-    return synonyms
+    return tuple(synonyms)
 
 
 def get_synonyms_for_token(token):
@@ -50,32 +81,156 @@ class NounPhrase():
     def __str__(self):
         return "<NOUN_PHRASE> {}".format(self.text)
 
-    def get_permutations(self, disable_wordnet=False):
+    def get_permutations(self, disable_wordnet=False, limit=None):
+        """
+        Noun phrase variants for the linking, the most promising first.
+
+        Args:
+            disable_wordnet (bool): skip synonymic permutations.
+            limit (int): maximal permutations count (None - all).
+
+        Returns:
+            list of NounPhrase: permutations.
+        """
+        permutations = self.iter_permutations(
+            disable_wordnet=disable_wordnet)
+        return list(itertools.islice(permutations, limit))
+
+    def iter_permutations(self, disable_wordnet=False):
+        """
+        Lazily generate unique permutations in the best-first order.
+
+        Score of a permutation is a structural completeness (share
+        of kept tokens) multiplied by scores of used synonyms.
+
+        Yields:
+            NounPhrase: permutation.
+        """
         # structural permutations
         # LOG.info("creating noun phrase permutations")
         permutations = [self]
         permutations += self.structural_permutations()
+        scored = [(len(permutation.tokens) / float(len(self.tokens)),
+                   permutation, )
+                  for permutation in permutations]
 
         if disable_wordnet:
-            return permutations
+            generators = [iter([(score, permutation, )])
+                          for score, permutation in scored]
+        else:
+            # continue with permutations generation
+            generators = [permutation.synonymic_permutations(score)
+                          for score, permutation in scored]
 
-        # continue with permutations generation
-        result = []
-        for permutation in permutations:
-            result += permutation.synonymic_permutations()
-        return result
+        # merge best-first generators
+        heap = []
+        for idx, generator in enumerate(generators):
+            for score, permutation in generator:
+                heapq.heappush(heap, (-score, idx, permutation, ))
+                break
+        seen = set()
+        while len(heap):
+            score, idx, permutation = heapq.heappop(heap)
+            if permutation.text not in seen:
+                seen.add(permutation.text)
+                yield permutation
+            for score, next_permutation in generators[idx]:
+                heapq.heappush(heap, (-score, idx, next_permutation, ))
+                break
+
+    def synonymic_permutations(self, base_score=1.0):
+        """
+        Lazily generate synonymic variants in the best-first order.
+
+        Args:
+            base_score (float): score of the noun phrase itself.
 
-    def synonymic_permutations(self):
+        Yields:
+            float, NounPhrase: score and variant.
+        """
         variations = []
         for token in self.tokens:
-            variation = []
-            variation.append(token)
-            for synonym in get_synonyms_for_token(token):
-                variation.append(synonym)
+            variation = [(1.0, token, )]
+            for rank, synonym in enumerate(get_synonyms_for_token(token)):
+                variation.append((synonym_score(str(token), synonym, rank),
+                                  synonym, ))
+            variation.sort(key=lambda option: -option[0])
             variations.append(variation)
             # print(variation)
-        tokens_tuples = list(itertools.product(*variations))
-        return [NounPhrase(tokens_tuple) for tokens_tuple in tokens_tuples]
+
+        for score, vector in best_first_product(variations, base_score):
+            yield score, NounPhrase(
+                [variation[idx][1]
+                 for variation, idx in zip(variations, vector)])
+
+
+def best_first_product(variations, base_score=1.0):
+    """
+    Lazily walk over the product of scored options in the best-first
+    order, each vector has the only parent (last nonzero index
+    decreased), so every vector is generated once.
+
+    >>> variations = [[(1.0, "big"), (0.5, "large")],
+    ...               [(1.0, "city"), (0.8, "town"), (0.2, "burg")]]
+    >>> walked = list(best_first_product(variations))
+    >>> [(round(score, 2), vector) for score, vector in walked]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(1.0, (0, 0)), (0.8, (0, 1)), (0.5, (1, 0)), (0.4, (1, 1)),
+     (0.2, (0, 2)), (0.1, (1, 2))]
+    >>> exhaustive = sorted(
+    ...     itertools.product(range(2), range(3)),
+    ...     key=lambda vector: -variations[0][vector[0]][0] *
+    ...                         variations[1][vector[1]][0])
+    >>> [vector for _, vector in walked] == exhaustive
+    True
+
+    Args:
+        variations (list): (score, option) pairs of every position,
+            sorted by the decreasing score.
+        base_score (float): score multiplier.
+
+    Yields:
+        float, tuple: score and indexes of options.
+    """
+    def score(vector):
+        result = base_score
+        for variation, idx in zip(variations, vector):
+            result *= variation[idx][0]
+        return result
+
+    start = (0, ) * len(variations)
+    heap = [(-score(start), start, )]
+    while len(heap):
+        negative_score, vector = heapq.heappop(heap)
+        yield -negative_score, vector
+        last = max([position
+                    for position, idx in enumerate(vector)
+                    if idx > 0] or [0])
+        for position in range(last, len(vector)):
+            if vector[position] + 1 < len(variations[position]):
+                successor = list(vector)
+                successor[position] += 1
+                successor = tuple(successor)
+                heapq.heappush(heap, (-score(successor), successor, ))
+
+
+def synonym_score(word, synonym, rank):
+    """
+    Score of the synonym replacement.
+    Frequent (WordNet order) and similar synonyms are preferred.
+
+    Args:
+        word (str): replaced word.
+        synonym (str): synonym.
+        rank (int): synonym position in the WordNet order.
+
+    Returns:
+        float: score (0, 1).
+    """
+    similarity = difflib.SequenceMatcher(None,
+                                         word.lower(),
+                                         synonym.lower()).ratio()
+    return SYNONYM_WEIGHT * (1.0 + similarity) / 2.0 / (1.0 + rank)
 
 
 class RootNounPhrase(NounPhrase):
@@ -86,61 +241,119 @@ class RootNounPhrase(NounPhrase):
         # LOG.info("Finished")
 
     def structural_permutations(self):
+        """
+        Noun phrases without dependent parts.
+
+        Only removals closed under dependencies (whole subtrees of
+        the non-root tokens) are enumerated. Number of variants is
+        computed beforehand, so too many variants are never generated.
+
+        Returns:
+            list of NounPhrase: permutations or [self] in case of more
+            than MAX_STRUCT_PERMUTATIONS permutations.
+        """
         # allow structural permutatations only for root NP,
         # only root NP contains spaCy doc inside
         tokens = self.tokens
         # calculate dependencies list
         indexes = [token.i for token in tokens]
         # print(indexes)
-        dependencies = []
+        children = [[] for _ in tokens]
+        tops = []
         for idx, token in enumerate(tokens):
             try:
-                dependencies.append(indexes.index(token.head.i))
+                head = indexes.index(token.head.i)
             except ValueError:
-                dependencies.append(idx)
-        # print("dependencies", dependencies)
-        # get skipping variations
-        indexes = list(range(len(tokens)))
-        # print(indexes)
-        skip_variations = []
-        for length in range(1, len(tokens)):
-            skip_variations.extend(itertools.combinations(indexes, length))
-        # extend skip variations using dependencies
-        skip_variations = [set(skip_variation)
-                           for skip_variation in skip_variations]
-
-        # print("skip_variations", skip_variations)
-        def extend_skip_variation(skip_variation):
-            new_skips = []
-            for index in skip_variation:
-                new_skips += [i for i, x in enumerate(dependencies)
-                              if x == index]
-            new_skips = set(new_skips)
-            # print(new_skips, skip_variation)
-            if len(new_skips) == 0 or new_skips <= skip_variation:
-                return skip_variation
+                head = idx
+            if head == idx:
+                tops.append(idx)
             else:
-                return extend_skip_variation(new_skips | skip_variation)
-        skip_variations = [extend_skip_variation(skip_variation)
-                           for skip_variation in skip_variations]
-        # filter skip variations
-        # to allow set(sets) we need to move to frozensets
-        skip_variations = [frozenset(x) for x in skip_variations]
-        skip_variations = list(set(skip_variations))
-        skip_variations = [skip_variation for skip_variation in skip_variations
-                           if len(skip_variation) < len(tokens)]
-        # print("processed skip_variations", skip_variations)
-        # apply eligable skip variations
-        permutations = []
-        for skip_variation in skip_variations:
-            def apply_skip_variation(tokens, variation):
-                result = []
-                for idx, element in enumerate(tokens):
-                    if idx not in list(variation):
-                        result.append(element)
-                return result
-            permutations.append(apply_skip_variation(tokens, skip_variation))
-        if len(permutations) > MAX_STRUCT_PERMUTATIONS:
+                children[head].append(idx)
+
+        # all dependencies closed removals (including empty and full)
+        total = 1
+        for top in tops:
+            total *= count_removals(subtree_shape(top, children))
+        # empty and full removals are not permutations
+        if total - 2 > MAX_STRUCT_PERMUTATIONS:
             return [self]
-        else:
-            return [NounPhrase(permutation) for permutation in permutations]
+
+        permutations = []
+        for removal in enumerate_removals(tops, children):
+            if 0 < len(removal) < len(tokens):
+                permutations.append(
+                    NounPhrase([token
+                                for idx, token in enumerate(tokens)
+                                if idx not in removal]))
+        return permutations
+
+
+def subtree_shape(node, children):
+    """
+    Canonical shape of the dependency subtree (nested sorted tuples).
+    """
+    return tuple(sorted(subtree_shape(child, children)
+                        for child in children[node]))
+
+
+@functools.lru_cache(maxsize=None)
+def count_removals(shape):
+    """
+    Count dependencies closed removals in the subtree of the shape.
+    Subtree is removed completely or its root is kept and children
+    subtrees are processed independently.
+    """
+    kept = 1
+    for child_shape in shape:
+        kept *= count_removals(child_shape)
+    return 1 + kept
+
+
+def enumerate_removals(nodes, children):
+    """
+    Generate dependencies closed removals for the subtrees of nodes.
+
+    Removals are the same as closures of all token subsets under
+    dependencies (the exhaustive enumeration), counted beforehand
+    by count_removals:
+
+    >>> children = [[1, 2], [], [3], []]  # 1 and 2 depend on 0, 3 on 2
+    >>> removals = sorted(sorted(removal)
+    ...                   for removal in enumerate_removals([0], children))
+    >>> removals
+    [[], [0, 1, 2, 3], [1], [1, 2, 3], [1, 3], [2, 3], [3]]
+    >>> closed = [sorted(subset)
+    ...           for length in range(len(children) + 1)
+    ...           for subset in itertools.combinations(range(4), length)
+    ...           if all(child in subset
+    ...                  for node in subset for child in children[node])]
+    >>> sorted(closed) == removals
+    True
+    >>> count_removals(subtree_shape(0, children)) == len(removals)
+    True
+
+    Yields:
+        frozenset: removed tokens indexes.
+    """
+    if len(nodes) == 0:
+        yield frozenset()
+        return
+    node, rest = nodes[0], nodes[1:]
+    for removal in subtree_removals(node, children):
+        for rest_removal in enumerate_removals(rest, children):
+            yield removal | rest_removal
+
+
+def subtree_removals(node, children):
+    # node is kept, children are processed
+    for removal in enumerate_removals(children[node], children):
+        yield removal
+    # whole subtree is removed
+    yield frozenset(subtree_nodes(node, children))
+
+
+def subtree_nodes(node, children):
+    result = [node]
+    for child in children[node]:
+        result += subtree_nodes(child, children)
+    return result
@@ -3,11 +3,16 @@ Module with classes related to pure NLP processing.
 (without linking with the data step)
 """
 
+import collections
+import hashlib
+
 from qas.noun_phrase import RootNounPhrase
 
+SIGNATURE_SEPARATOR = "\x1f"
+
 
 class Sentence():
-    def __init__(self, text, nlp, log, settings):
+    def __init__(self, text, nlp, log, settings, doc=None):
 
         # save qas services
         self.nlp = nlp
@@ -19,7 +24,8 @@ class Sentence():
         self.text = text
 
         # parse sentence structure using spaCy
-        self.spacy_doc = self.nlp(self.text)
+        # (unless already parsed in a batch)
+        self.spacy_doc = self.nlp(self.text) if doc is None else doc
         self.log.debug("Sentence structure parsed using spaCy.")
 
         # transform to internal unified represe
@@ -32,24 +38,23 @@ class Sentence():
     def get_noun_phrases(self):
         self.log.debug("Searching for noun phrases")
 
-        def extend_spacy_token(token):
-            def extend_token(token):
-                result = [token]
-                for child in token.children:
-                    result += extend_token(child)
-                return result
-            tokens = extend_token(token)
-            #  rewrite with token subtree
-            return sorted(tokens, key=lambda x: x.idx)
-
         # understand where to disable WordNet permutations
         # self.log.warning("WordNet permutations are disabled at the moment")
         # noun_phrases = []
+        tokens = list(self.spacy_doc)
+        spans = subtree_spans(self.spacy_doc)
         indexed_noun_phrases = []
-        for possible_noun in self.spacy_doc:
+        for possible_noun in tokens:
             # the module skips WPs
             if possible_noun.tag_ in ["NN", "NNS", "NNP", "NNPS", "CD"]:
-                noun_phrase = RootNounPhrase(extend_spacy_token(possible_noun))
+                left, right, size = spans[possible_noun.i]
+                if right - left + 1 == size:
+                    subtree = tokens[left:right + 1]
+                else:
+                    # non-projective subtree, not a continuous span
+                    subtree = sorted(possible_noun.subtree,
+                                     key=lambda x: x.idx)
+                noun_phrase = RootNounPhrase(subtree)
                 indexed_noun_phrases.append((possible_noun.i, noun_phrase, ))
         return indexed_noun_phrases
 
@@ -58,6 +63,54 @@ class Sentence():
     #         print(word.i, word.text, word.lemma, word.lemma_, word.tag, word.tag_, word.pos, word.pos_)
 
 
+def subtree_spans(doc):
+    """
+    Subtree spans of all tokens computed in a single bottom-up pass.
+
+    >>> from types import SimpleNamespace as Token
+    >>> doc = [Token(i=idx) for idx in range(5)]
+    >>> for token, head in zip(doc, [1, 1, 1, 4, 2]):  # 1 is the root
+    ...     token.head = doc[head]
+    >>> for token in doc:
+    ...     token.children = [child for child in doc
+    ...                       if child.head is token and child is not token]
+    >>> subtree_spans(doc)
+    [(0, 0, 1), (0, 4, 5), (2, 4, 3), (3, 3, 1), (3, 4, 2)]
+    >>> def subtree(token):  # recursive subtree (as spaCy token.subtree)
+    ...     return [token.i] + [idx for child in token.children
+    ...                         for idx in subtree(child)]
+    >>> subtree_spans(doc) == [(min(subtree(token)), max(subtree(token)),
+    ...                         len(subtree(token))) for token in doc]
+    True
+
+    Args:
+        doc (spacy.tokens.Doc): parsed sentence.
+
+    Returns:
+        list: (left index, right index, size) of the token subtree
+            for every token of the doc.
+    """
+    tokens = list(doc)
+    spans = [[token.i, token.i, 1] for token in tokens]
+    # pre-order of the dependency tree, reversed one visits children
+    # before their heads
+    order = []
+    stack = [token for token in tokens if token.head.i == token.i]
+    while stack:
+        token = stack.pop()
+        order.append(token)
+        stack.extend(token.children)
+    for token in reversed(order):
+        head = token.head.i
+        if head == token.i:
+            continue
+        span, head_span = spans[token.i], spans[head]
+        head_span[0] = min(head_span[0], span[0])
+        head_span[1] = max(head_span[1], span[1])
+        head_span[2] += span[2]
+    return [tuple(span) for span in spans]
+
+
 class ParseTree():
     """
     Unified representation of a sentence tree.
@@ -73,6 +126,11 @@ class ParseTree():
         self.links = []
         for word in self.spacy_doc:
             self.links.append(Link(word))
+        # signatures of links for the fast comparison
+        self.strict_signatures = frozenset(
+            link.strict_signature for link in self.links)
+        self.flexible_signatures = frozenset(
+            link.flexible_signature for link in self.links)
 
     @staticmethod
     def filter_punctuation(doc):
@@ -89,6 +147,8 @@ class ParseTree():
     def similarity(self, other):
         """
         Return relative similarity to another ParseTree.
+        Link is found if other tree has a link with the same signature
+        (linear time with signatures sets).
 
         Args:
             other (ParseTree): other sentence
@@ -96,38 +156,68 @@ class ParseTree():
         Returns:
             float: percentage of similar links
         """
+        if len(self.links) == 0:
+            return 0.0
         links_found = 0
-        for link1 in self.links:
-            for link2 in other.links:
-                if link1 == link2:
+        for link in self.links:
+            if link.flexible:
+                if link.flexible_signature in other.flexible_signatures:
                     links_found += 1
-                    break
+            elif link.strict_signature in other.strict_signatures:
+                links_found += 1
         return links_found/float(len(self.links))
 
 
+def signature(*parts):
+    """
+    Stable 64-bit hash of link parts (same in all processes).
+
+    Args:
+        *parts (str): link type, POS tags, lemmas.
+
+    Returns:
+        int: signature.
+    """
+    data = SIGNATURE_SEPARATOR.join(parts).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'little')
+
+
+Word = collections.namedtuple('Word', ['idx', 'text', 'lemma', 'pos', 'tag'])
+
+
 class Link():
     """
     Unified link representations.
+
+    Flexible signature covers POS tags and the link type,
+    strict signature additionally covers lemmas.
     """
+    __slots__ = ('target', 'type', 'flexible', 'source',
+                 'flexible_signature', 'strict_signature')
+
     def __init__(self, word, flexible=False):
-        # change text vars to int
         # word.idx contents position inside of the doc
-        self.target = {
-            "idx": word.idx,
-            "text": word.text,
-            "lemma": word.lemma_,
-            "pos": word.pos_,
-            "tag": word.tag_
-        }
+        self.target = Word(word.idx,
+                           word.text,
+                           word.lemma_,
+                           word.pos_,
+                           word.tag_)
         self.type = word.dep_
         self.flexible = flexible
-        self.source = {
-            "idx": word.head.idx,
-            "text": word.head.text,
-            "lemma": word.head.lemma_,
-            "pos": word.head.pos_,
-            "tag": word.head.tag_
-        }
+        self.source = Word(word.head.idx,
+                           word.head.text,
+                           word.head.lemma_,
+                           word.head.pos_,
+                           word.head.tag_)
+        self.flexible_signature = signature(self.type,
+                                            self.source.pos,
+                                            self.target.pos)
+        self.strict_signature = signature(self.type,
+                                          self.source.pos,
+                                          self.target.pos,
+                                          self.source.lemma,
+                                          self.target.lemma)
 
     def __eq__(self, other):
         """
@@ -141,25 +231,19 @@ class Link():
         Returns:
             bool: links are same
         """
-        target_pos = self.target["pos"] == other.target["pos"]
-        source_pos = self.source["pos"] == other.source["pos"]
-        link_type = self.type == other.type
-        target_lemma = self.target["lemma"] == other.target["lemma"]
-        source_lemma = self.source["lemma"] == other.source["lemma"]
         if self.flexible:
-            return target_pos and source_pos and link_type
+            return self.flexible_signature == other.flexible_signature
         else:
-            return target_pos and source_pos and link_type and \
-                   target_lemma and source_lemma
+            return self.strict_signature == other.strict_signature
 
     def __str__(self):
         result = "<LINK> {}.{}.{}#{} ==[{}]==> {}.{}.{}#{}"
-        return result.format(self.source["lemma"],
-                             self.source["tag"],
-                             self.source["pos"],
-                             self.source["idx"],
+        return result.format(self.source.lemma,
+                             self.source.tag,
+                             self.source.pos,
+                             self.source.idx,
                              self.type,
-                             self.target["lemma"],
-                             self.target["tag"],
-                             self.target["pos"],
-                             self.target["idx"])
+                             self.target.lemma,
+                             self.target.tag,
+                             self.target.pos,
+                             self.target.idx)
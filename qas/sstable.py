@@ -0,0 +1,251 @@
+"""
+Sorted string tables.
+
+Immutable key-value tables stored in a single file and accessed via
+mmap, lookups are binary searches over the sorted keys. Used by the
+offline indexes (labels, synonyms, n-grams).
+
+File layout (native byte order):
+    magic (4 bytes), version (uint32), count (uint64),
+    key offsets (count + 1 uint64), value offsets (count + 1 uint64),
+    keys blob, values blob.
+"""
+
+import array
+import heapq
+import itertools
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+
+MAGIC = b'QSST'
+VERSION = 1
+HEADER = struct.Struct('=4sIQ')
+OFFSET = struct.Struct('=Q')
+RUN_SIZE = 1000000  # items sorted in memory at once
+
+
+class InvalidTable(Exception):
+    pass
+
+
+class ExternalSort(object):
+    """
+    Sort of more items than fit in memory: sorted runs are pickled
+    to temporary files and merged.
+
+    >>> sort = ExternalSort(run_size=2)
+    >>> for item in [(b'c', 3), (b'a', 1), (b'd', 4), (b'b', 2), (b'a', 0)]:
+    ...     sort.add(item)
+    >>> list(sort)
+    [(b'a', 0), (b'a', 1), (b'b', 2), (b'c', 3), (b'd', 4)]
+
+    Attributes:
+        run_size (int): items sorted in memory at once.
+    """
+    def __init__(self, run_size=RUN_SIZE):
+        self.run_size = run_size
+        self.run = []
+        self.runs = []
+
+    def add(self, item):
+        self.run.append(item)
+        if len(self.run) >= self.run_size:
+            self.flush()
+
+    def flush(self):
+        run_file = tempfile.TemporaryFile()  # removed when closed
+        self.run.sort()
+        for item in self.run:
+            pickle.dump(item, run_file, protocol=pickle.HIGHEST_PROTOCOL)
+        run_file.seek(0)
+        self.runs.append(run_file)
+        self.run = []
+
+    @staticmethod
+    def read_run(run_file):
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+    def __iter__(self):
+        """
+        Sorted items (once, the runs are removed afterwards).
+        """
+        try:
+            if len(self.runs) == 0:
+                self.run.sort()
+                yield from self.run
+            else:
+                if len(self.run):
+                    self.flush()
+                yield from heapq.merge(*[self.read_run(run_file)
+                                         for run_file in self.runs])
+        finally:
+            for run_file in self.runs:
+                run_file.close()
+            self.run = []
+            self.runs = []
+
+
+def external_sort(items, run_size=RUN_SIZE):
+    """
+    Sorted items (see ExternalSort).
+    """
+    sort = ExternalSort(run_size=run_size)
+    for item in items:
+        sort.add(item)
+    return iter(sort)
+
+
+def group_rows(pairs):
+    """
+    Group sorted (key, row) pairs into (key, rows) table items,
+    rows are packed as uint32 array.
+    """
+    for key, group in itertools.groupby(pairs, key=lambda pair: pair[0]):
+        yield key, array.array('I', [pair[-1] for pair in group]).tobytes()
+
+
+def write_table(filename, items, presorted=False):
+    """
+    Write a sorted string table.
+
+    Items are streamed to the file, they are sorted externally unless
+    they are already sorted, so tables larger than the memory can be
+    written.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> filename = os.path.join(directory, 'example.table')
+    >>> write_table(filename, [(b'b', b'2'), (b'ab', b''), (b'a', b'1')])
+    >>> table = Table(filename)
+    >>> [(table.key(idx), table.value(idx)) for idx in range(len(table))]
+    [(b'a', b'1'), (b'ab', b''), (b'b', b'2')]
+    >>> table.get(b'ab'), table.get(b'c'), table.find(b'b')
+    (b'', None, 2)
+    >>> [table.key(idx) for idx in table.prefix(b'a')]
+    [b'a', b'ab']
+    >>> table.close()
+    >>> shutil.rmtree(directory)
+
+    Args:
+        filename (str): output file.
+        items (iterable): (key bytes, value bytes) pairs, keys are unique.
+        presorted (bool): items are already sorted by keys.
+
+    Raises:
+        ValueError: keys of presorted items are not sorted or unique.
+    """
+    if not presorted:
+        items = external_sort(items)
+    parts = [tempfile.TemporaryFile() for _ in range(4)]
+    key_offsets, value_offsets, keys, values = parts
+    try:
+        key_offsets.write(OFFSET.pack(0))
+        value_offsets.write(OFFSET.pack(0))
+        count, key_end, value_end = 0, 0, 0
+        previous = None
+        for key, value in items:
+            if previous is not None and key <= previous:
+                raise ValueError("Keys are not sorted or unique: {!r}".format(
+                    key))
+            previous = key
+            key_end += len(key)
+            value_end += len(value)
+            key_offsets.write(OFFSET.pack(key_end))
+            value_offsets.write(OFFSET.pack(value_end))
+            keys.write(key)
+            values.write(value)
+            count += 1
+        # write to a temporary file, readers never see a partial table
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as table_file:
+            table_file.write(HEADER.pack(MAGIC, VERSION, count))
+            for part in parts:
+                part.seek(0)
+                shutil.copyfileobj(part, table_file)
+        os.replace(temporary, filename)
+    finally:
+        for part in parts:
+            part.close()
+
+
+class Table(object):
+    """
+    Memory-mapped sorted string table (read only).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as table_file:
+            self.mmap = mmap.mmap(table_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, version, self.count = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise InvalidTable(filename)
+        view = memoryview(self.mmap)
+        offsets_size = (self.count + 1) * 8
+        key_view = view[HEADER.size:HEADER.size + offsets_size]
+        value_view = view[HEADER.size + offsets_size:
+                          HEADER.size + 2 * offsets_size]
+        self.key_offsets = key_view.cast('Q')
+        self.value_offsets = value_view.cast('Q')
+        # views are released before the mmap is closed
+        self.views = [self.key_offsets, self.value_offsets,
+                      key_view, value_view, view]
+        self.keys_start = HEADER.size + 2 * offsets_size
+        self.values_start = self.keys_start + self.key_offsets[self.count]
+
+    def __len__(self):
+        return self.count
+
+    def key(self, idx):
+        return self.mmap[self.keys_start + self.key_offsets[idx]:
+                         self.keys_start + self.key_offsets[idx + 1]]
+
+    def value(self, idx):
+        return self.mmap[self.values_start + self.value_offsets[idx]:
+                         self.values_start + self.value_offsets[idx + 1]]
+
+    def bisect(self, key):
+        """
+        Index of the first key which is not less than the given one.
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, key):
+        idx = self.bisect(key)
+        if idx < self.count and self.key(idx) == key:
+            return idx
+        return None
+
+    def get(self, key, default=None):
+        idx = self.find(key)
+        if idx is None:
+            return default
+        return self.value(idx)
+
+    def prefix(self, prefix):
+        """
+        Indexes of all keys starting with the prefix (lazy).
+        """
+        idx = self.bisect(prefix)
+        while idx < self.count and self.key(idx).startswith(prefix):
+            yield idx
+            idx += 1
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.mmap.close()
@@ -0,0 +1,397 @@
+"""
+Knowledge store (SQLite in WAL mode).
+
+Every learned question-answer pair is a single row, so adding a record
+doesn't rewrite the others:
+
+    records: id, question, question_hash, answer, solution (JSON)
+    record_items: record id, position, Wikidata item id
+    record_types: record id, type (instance of) of the question items
+    item_types: Wikidata item id, type id ('' for items without types)
+    links: structural signature (qas.structural_index), record id
+    templates: template hash (qas.template_index), record id
+
+Record ids are positions of the records (rows of the vector index).
+"""
+
+import dbm
+import hashlib
+import json
+import shelve
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    question TEXT NOT NULL,
+    question_hash TEXT NOT NULL,
+    answer TEXT,
+    solution TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_question_hash
+    ON records (question_hash);
+CREATE TABLE IF NOT EXISTS record_items (
+    record_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    item_id TEXT NOT NULL,
+    PRIMARY KEY (record_id, position)
+);
+CREATE INDEX IF NOT EXISTS record_items_item_id
+    ON record_items (item_id);
+CREATE TABLE IF NOT EXISTS record_types (
+    record_id INTEGER NOT NULL,
+    type_id TEXT NOT NULL,
+    PRIMARY KEY (record_id, type_id)
+);
+CREATE INDEX IF NOT EXISTS record_types_type_id
+    ON record_types (type_id);
+CREATE TABLE IF NOT EXISTS item_types (
+    item_id TEXT NOT NULL,
+    type_id TEXT NOT NULL,
+    PRIMARY KEY (item_id, type_id)
+);
+CREATE TABLE IF NOT EXISTS links (
+    signature INTEGER NOT NULL,
+    record_id INTEGER NOT NULL,
+    PRIMARY KEY (signature, record_id)
+);
+CREATE TABLE IF NOT EXISTS templates (
+    template_hash INTEGER PRIMARY KEY,
+    record_id INTEGER NOT NULL
+);
+"""
+BATCH_SIZE = 1000
+SHARED_LIMIT = 20
+MAX_VARIABLES = 500  # SQLite host parameters per query
+
+
+def question_hash(question):
+    return hashlib.blake2b(question.encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+
+def to_signed(value):
+    # 64-bit hashes are unsigned, SQLite integers are signed
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class KnowledgeStore(object):
+    """
+    Learned question-answer pairs.
+
+    The connection is shared by threads (warm-up threads load indexes),
+    every statement and transaction runs under the lock.
+
+    Attributes:
+        filename (str): SQLite database file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.lock = threading.RLock()
+        self.open()
+
+    def open(self):
+        """
+        Connect to the database (again after close).
+        """
+        with self.lock:
+            # used by other threads under the lock
+            self.connection = sqlite3.connect(self.filename,
+                                              check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+            self.connection.commit()
+
+    def execute(self, query, parameters=()):
+        """
+        Run the query under the lock.
+
+        Returns:
+            list: all result rows.
+        """
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def executemany(self, query, rows):
+        with self.lock:
+            self.connection.executemany(query, rows)
+
+    def __len__(self):
+        return self.execute("SELECT COUNT(*) FROM records")[0][0]
+
+    def __iter__(self):
+        """
+        Stream all records ordered by id (fetched in batches).
+        """
+        start = 0
+        while True:
+            rows = self.execute(
+                "SELECT id, question, answer, solution FROM records "
+                "WHERE id >= ? ORDER BY id LIMIT ?", (start, BATCH_SIZE))
+            for row in rows:
+                yield self.record(row)
+            if len(rows) < BATCH_SIZE:
+                return
+            start = rows[-1][0] + 1
+
+    def record(self, row):
+        record_id, question, answer, solution = row
+        return {
+            "id": record_id,
+            "question": question,
+            "answer": answer,
+            "items": self.items(record_id),
+            "solution": json.loads(solution)
+        }
+
+    def get(self, record_id):
+        rows = self.execute(
+            "SELECT id, question, answer, solution FROM records WHERE id = ?",
+            (record_id, ))
+        return self.record(rows[0]) if len(rows) else None
+
+    def __getitem__(self, record_id):
+        record = self.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def questions(self, start=0):
+        """
+        Stream (id, question) pairs starting from the record id
+        (fetched in batches).
+        """
+        while True:
+            rows = self.execute(
+                "SELECT id, question FROM records WHERE id >= ? "
+                "ORDER BY id LIMIT ?", (start, BATCH_SIZE))
+            yield from rows
+            if len(rows) < BATCH_SIZE:
+                return
+            start = rows[-1][0] + 1
+
+    def items(self, record_id):
+        return [item_id
+                for item_id, in self.execute(
+                    "SELECT item_id FROM record_items "
+                    "WHERE record_id = ? ORDER BY position",
+                    (record_id, ))]
+
+    def shared_records(self, table, column, values, limit=SHARED_LIMIT):
+        """
+        Records sharing the most values (items or types).
+
+        Args:
+            table (str): record_items or record_types.
+            column (str): item_id or type_id.
+            values (iterable of str): searched values.
+            limit (int): maximal number of records.
+
+        Returns:
+            list of int: record ids, the most shared first.
+        """
+        values = list(dict.fromkeys(values))
+        shared = {}
+        for offset in range(0, len(values), MAX_VARIABLES):
+            chunk = values[offset:offset + MAX_VARIABLES]
+            query = "SELECT record_id, COUNT(DISTINCT {column}) " \
+                "FROM {table} WHERE {column} IN ({variables}) GROUP BY record_id".format(
+                    table=table,
+                    column=column,
+                    variables=", ".join("?" * len(chunk)))
+            for record_id, count in self.execute(query, chunk):
+                shared[record_id] = shared.get(record_id, 0) + count
+        records = sorted(shared, key=lambda record_id: (-shared[record_id],
+                                                        record_id))
+        return records[:limit]
+
+    def records_by_items(self, item_ids, limit=SHARED_LIMIT):
+        return self.shared_records("record_items", "item_id", item_ids,
+                                   limit=limit)
+
+    def records_by_types(self, type_ids, limit=SHARED_LIMIT):
+        return self.shared_records("record_types", "type_id", type_ids,
+                                   limit=limit)
+
+    def item_types(self, item_ids):
+        """
+        Locally known types of the items.
+
+        Returns:
+            dict: item id -> list of type ids (only known items).
+        """
+        item_ids = list(item_ids)
+        types = {}
+        for offset in range(0, len(item_ids), MAX_VARIABLES):
+            chunk = item_ids[offset:offset + MAX_VARIABLES]
+            rows = self.execute(
+                "SELECT item_id, type_id FROM item_types "
+                "WHERE item_id IN ({}) ORDER BY rowid".format(
+                    ", ".join("?" * len(chunk))),
+                chunk)
+            for item_id, type_id in rows:
+                known = types.setdefault(item_id, [])
+                if type_id:
+                    known.append(type_id)
+        return types
+
+    def add_item_types(self, types, commit=True):
+        """
+        Store types of the items.
+
+        Args:
+            types (dict): item id -> list of type ids.
+            commit (bool): commit the transaction.
+        """
+        self.executemany(
+            "INSERT OR IGNORE INTO item_types (item_id, type_id) "
+            "VALUES (?, ?)",
+            [(item_id, type_id, )
+             for item_id, type_ids in types.items()
+             for type_id in (type_ids or [''])])
+        if commit:
+            self.commit()
+
+    def find_question(self, question):
+        """
+        Id of the record with the question or None.
+        """
+        for record_id, stored in self.execute(
+                "SELECT id, question FROM records WHERE question_hash = ?",
+                (question_hash(question), )):
+            if stored == question:
+                return record_id
+        return None
+
+    def add(self, record, signatures=(), template_hash=None, types=(),
+            commit=True):
+        """
+        Insert a new record (id is assigned to the record).
+
+        Args:
+            record (dict): question, answer, items and solution.
+            signatures (iterable of int): structural signatures
+                of the question.
+            template_hash (int): question template hash or None.
+            types (iterable of str): types of the question items.
+            commit (bool): commit the transaction.
+
+        Returns:
+            int: record id.
+        """
+        with self.lock:
+            # ids are continuous, the next one is after the last rowid
+            record_id = self.execute(
+                "SELECT COALESCE(MAX(id) + 1, 0) FROM records")[0][0]
+            record['id'] = record_id
+            self.execute(
+                "INSERT INTO records (id, question, question_hash, answer, "
+                "solution) VALUES (?, ?, ?, ?, ?)",
+                (record_id, record['question'],
+                 question_hash(record['question']),
+                 record['answer'], json.dumps(record['solution'])))
+            self.executemany(
+                "INSERT INTO record_items (record_id, position, item_id) "
+                "VALUES (?, ?, ?)",
+                [(record_id, position, item_id, )
+                 for position, item_id in enumerate(record['items'])])
+            self.executemany(
+                "INSERT OR IGNORE INTO record_types (record_id, type_id) "
+                "VALUES (?, ?)",
+                [(record_id, type_id, ) for type_id in types])
+            self.add_links(record_id, signatures, commit=False)
+            if template_hash is not None:
+                self.add_template(template_hash, record_id, commit=False)
+            if commit:
+                self.commit()
+        return record_id
+
+    def add_links(self, record_id, signatures, commit=True):
+        self.executemany(
+            "INSERT OR IGNORE INTO links (signature, record_id) VALUES (?, ?)",
+            [(to_signed(signature), record_id, ) for signature in signatures])
+        if commit:
+            self.commit()
+
+    def add_template(self, template_hash, record_id, commit=True):
+        # the first record with the template is kept
+        self.execute(
+            "INSERT OR IGNORE INTO templates (template_hash, record_id) "
+            "VALUES (?, ?)",
+            (to_signed(template_hash), record_id, ))
+        if commit:
+            self.commit()
+
+    def has_links(self):
+        return len(self.execute("SELECT 1 FROM links LIMIT 1")) > 0
+
+    def links(self):
+        """
+        (signature, record id) pairs.
+        """
+        for signature, record_id in self.execute(
+                "SELECT signature, record_id FROM links ORDER BY record_id"):
+            yield to_unsigned(signature), record_id
+
+    def templates(self):
+        """
+        (template hash, record id) pairs.
+        """
+        for template_hash, record_id in self.execute(
+                "SELECT template_hash, record_id FROM templates"):
+            yield to_unsigned(template_hash), record_id
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def migrate_shelve(filename, store, log=None):
+    """
+    Copy records and indexes of the old shelve database to the store.
+
+    Args:
+        filename (str): shelve database file.
+        store (KnowledgeStore): empty store.
+
+    Returns:
+        int: number of migrated records.
+    """
+    try:
+        database = shelve.open(filename, flag='r')
+    except dbm.error:  # no old database
+        return 0
+    with database:
+        knowledge = database.get('knowledge', [])
+        if log is not None and len(knowledge):
+            log.info('Migrating %d records from %s', len(knowledge), filename)
+        for position, record in enumerate(knowledge):
+            store.add({
+                "question": record['question'],
+                "answer": record['answer'],
+                "items": record.get('items', []),
+                "solution": record['solution']
+            }, commit=(position + 1) % BATCH_SIZE == 0)
+        if 'structural_index' in database:
+            postings = database['structural_index']['postings']
+            for signature, record_ids in postings.items():
+                for record_id in record_ids:
+                    store.add_links(record_id, [signature], commit=False)
+        if 'template_index' in database:
+            templates = database['template_index']['templates']
+            for template_hash, record_id in templates.items():
+                store.add_template(template_hash, record_id, commit=False)
+    store.commit()
+    return len(knowledge)
@@ -0,0 +1,105 @@
+"""
+Structural inverted index over stored questions.
+
+Strict link signatures of question parse trees (link type, POS tags
+and lemmas, see qas.sentence.Link) point to knowledge records, so
+structurally similar reference questions are found without scanning
+all of them.
+"""
+
+import math
+
+TOP_K = 20
+MAX_DOCUMENT_FREQUENCY = 0.5  # skip links shared by most of questions
+
+
+class StructuralIndex(object):
+    """
+    Link signature -> record ids inverted index.
+
+    >>> from types import SimpleNamespace as Tree
+    >>> index = StructuralIndex()
+    >>> for record_id, signatures in enumerate([{1, 2, 3}, {1, 4}, {1, 5}]):
+    ...     index.add(record_id, Tree(strict_signatures=signatures))
+    >>> question = Tree(strict_signatures={1, 2, 4})
+    >>> [record_id for _, record_id in index.top_k(question)]
+    [1, 0]
+    >>> links = [(signature, record_id)
+    ...          for signature, record_ids in index.postings.items()
+    ...          for record_id in record_ids]
+    >>> loaded = StructuralIndex.from_links(links)
+    >>> loaded.top_k(question) == index.top_k(question)
+    True
+
+    Attributes:
+        postings (dict): signature -> list of record ids.
+        sizes (dict): record id -> number of unique signatures.
+    """
+    def __init__(self, postings=None, sizes=None):
+        self.postings = {} if postings is None else postings
+        self.sizes = {} if sizes is None else sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, record_id, tree):
+        """
+        Index a stored question.
+
+        Args:
+            record_id (int): knowledge record id.
+            tree (qas.sentence.ParseTree): question parse tree.
+        """
+        if record_id in self.sizes:
+            return
+        for signature in tree.strict_signatures:
+            self.postings.setdefault(signature, []).append(record_id)
+        self.sizes[record_id] = len(tree.strict_signatures)
+
+    def top_k(self, tree, k=TOP_K):
+        """
+        Records with the most similar questions structure.
+
+        Only postings of the question signatures are visited, links
+        shared by most of stored questions are skipped (unless nothing
+        else is shared). Shared links are weighted by IDF.
+
+        Args:
+            tree (qas.sentence.ParseTree): question parse tree.
+            k (int): maximal number of records.
+
+        Returns:
+            list: (score, record id) pairs, the best first.
+        """
+        count = len(self.sizes)
+        if count == 0:
+            return []
+        postings = [self.postings[signature]
+                    for signature in tree.strict_signatures
+                    if signature in self.postings]
+        rare = [posting
+                for posting in postings
+                if len(posting) <= MAX_DOCUMENT_FREQUENCY * count]
+        if len(rare):
+            postings = rare
+        scores = {}
+        for posting in postings:
+            weight = math.log(1.0 + count / float(len(posting)))
+            for record_id in posting:
+                scores[record_id] = scores.get(record_id, 0.0) + weight
+        # prefer records with a similar number of links
+        results = [(score / math.sqrt(self.sizes[record_id]), record_id, )
+                   for record_id, score in scores.items()]
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results[:k]
+
+    @classmethod
+    def from_links(cls, links):
+        """
+        Create the index from stored (signature, record id) pairs.
+        """
+        index = cls()
+        for signature, record_id in links:
+            index.postings.setdefault(signature, []).append(record_id)
+            index.sizes[record_id] = index.sizes.get(record_id, 0) + 1
+        return index
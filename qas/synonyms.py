@@ -0,0 +1,189 @@
+"""
+Precomputed WordNet synonyms table.
+
+The table is built once from WordNet and stored as a sorted string
+table (qas.sstable), so NLTK corpus loader is not needed at runtime:
+
+    POS + separator + lemma -> synonyms (WordNet order)
+    ! + POS + separator + inflected form -> base forms (exception lists)
+
+Base forms of words are found as by WordNet morphy: the exception
+lists (*.exc files, e.g. children -> child) are checked first, then
+the detachment rules are applied.
+
+Usage:
+python3 -m qas.synonyms synonyms.table
+"""
+
+import sys
+
+from qas.sstable import Table, write_table
+
+SEPARATOR = '\x1f'
+EXCEPTION_PREFIX = '!'
+POS_TAGS = ["NOUN", "VERB", "ADJ", "ADV"]
+EXCEPTION_FILES = {
+    "NOUN": "noun.exc",
+    "VERB": "verb.exc",
+    "ADJ": "adj.exc",
+    "ADV": "adv.exc"
+}
+
+# WordNet morphy detachment rules
+SUBSTITUTIONS = {
+    "NOUN": [("s", ""), ("ses", "s"), ("ves", "f"), ("xes", "x"),
+             ("zes", "z"), ("ches", "ch"), ("shes", "sh"),
+             ("men", "man"), ("ies", "y")],
+    "VERB": [("s", ""), ("ies", "y"), ("es", "e"), ("es", ""),
+             ("ed", "e"), ("ed", ""), ("ing", "e"), ("ing", "")],
+    "ADJ": [("er", ""), ("est", ""), ("er", "e"), ("est", "e")],
+    "ADV": []
+}
+
+
+def table_key(lemma, pos=None):
+    return ((pos or "") + SEPARATOR + lemma).encode('utf-8')
+
+
+def exception_key(form, pos):
+    return (EXCEPTION_PREFIX + pos + SEPARATOR + form).encode('utf-8')
+
+
+def apply_rules(forms, pos):
+    return [form[:len(form) - len(suffix)] + replacement
+            for form in forms
+            for suffix, replacement in SUBSTITUTIONS[pos]
+            if form.endswith(suffix)]
+
+
+def unique(values):
+    return list(dict.fromkeys(values))
+
+
+def build(filename):
+    """
+    Build the synonyms table from the WordNet corpus.
+
+    Args:
+        filename (str): output table file.
+    """
+    from nltk.corpus import wordnet
+    wordnet_pos = {
+        "NOUN": wordnet.NOUN,
+        "VERB": wordnet.VERB,
+        "ADJ": wordnet.ADJ,
+        "ADV": wordnet.ADV
+    }
+    items = {}
+    for pos in POS_TAGS:
+        for lemma in wordnet.all_lemma_names(pos=wordnet_pos[pos]):
+            synonyms = []
+            for synset in wordnet.synsets(lemma, pos=wordnet_pos[pos]):
+                synonyms += [str(name.name()).replace("_", " ")
+                             for name in synset.lemmas()]
+            items[table_key(lemma, pos)] = unique(synonyms)
+        # irregular forms (same as the morphy exception lists)
+        with wordnet.open(EXCEPTION_FILES[pos]) as exceptions_file:
+            for line in exceptions_file:
+                terms = line.split()
+                if len(terms) > 1:
+                    items[exception_key(terms[0], pos)] = terms[1:]
+    write_table(filename,
+                ((key, SEPARATOR.join(synonyms).encode('utf-8'), )
+                 for key, synonyms in items.items()))
+
+
+class SynonymTable(object):
+    """
+    Memory-mapped synonyms table.
+    """
+    def __init__(self, filename):
+        self.table = Table(filename)
+
+    def lemma_synonyms(self, lemma, pos=None):
+        value = self.table.get(table_key(lemma, pos))
+        if value is None:
+            return None
+        if len(value) == 0:
+            return []
+        return value.decode('utf-8').split(SEPARATOR)
+
+    def known(self, forms, pos):
+        return [form
+                for form in unique(forms)
+                if self.table.find(table_key(form, pos)) is not None]
+
+    def exceptions(self, form, pos):
+        value = self.table.get(exception_key(form, pos))
+        if value is None:
+            return None
+        return value.decode('utf-8').split(SEPARATOR)
+
+    def morphy(self, form, pos):
+        """
+        Base forms of the word known to the table (WordNet morphy).
+        """
+        exceptions = self.exceptions(form, pos)
+        if exceptions is not None:
+            return self.known([form] + exceptions, pos)
+        forms = apply_rules([form], pos)
+        results = self.known([form] + forms, pos)
+        # rules are applied until any form is known
+        while len(results) == 0 and len(forms):
+            forms = apply_rules(forms, pos)
+            results = self.known(forms, pos)
+        return results
+
+    def lemmas(self, word, pos=None):
+        """
+        Base forms of the word, which are known to the table.
+        """
+        word = word.lower()
+        return unique(lemma
+                      for rule_pos in ([pos] if pos else POS_TAGS)
+                      for lemma in self.morphy(word, rule_pos))
+
+    def synonyms(self, word, pos=None):
+        """
+        Synonyms of the word (same as WordNet lemmas of its synsets).
+
+        >>> import os, shutil, tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> filename = os.path.join(directory, 'synonyms.table')
+        >>> write_table(filename, [
+        ...     (table_key("child", "NOUN"), b"child\x1fkid"),
+        ...     (table_key("city", "NOUN"), b"city\x1fmetropolis"),
+        ...     (exception_key("children", "NOUN"), b"child")])
+        >>> table = SynonymTable(filename)
+        >>> table.synonyms("children"), table.synonyms("cities", pos="NOUN")
+        (['child', 'kid'], ['city', 'metropolis'])
+        >>> table.close()
+        >>> shutil.rmtree(directory)
+
+        Args:
+            word (str): word (possibly inflected).
+            pos (str): spaCy POS tag or None for all of them.
+
+        Returns:
+            list of str: synonyms in the WordNet order.
+        """
+        synonyms = []
+        for rule_pos in ([pos] if pos else POS_TAGS):
+            for lemma in self.morphy(word.lower(), rule_pos):
+                synonyms += self.lemma_synonyms(lemma, pos=rule_pos)
+        return [synonym
+                for synonym in unique(synonyms)
+                if synonym != word]
+
+    def close(self):
+        self.table.close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python3 -m qas.synonyms TABLE_FILENAME")
+    build(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
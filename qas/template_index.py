@@ -0,0 +1,206 @@
+"""
+Masked question templates index.
+
+Stored questions are turned into templates: tokens of the permutation,
+which linked the item the answer path starts from, are replaced by
+a slot, the rest of the tokens are kept as lemmas:
+
+    "Who is the president of France?" -> "who be the president of <slot>"
+
+Template hashes point to knowledge records, so a question sharing the
+template with a stored one finds its reference with a few lookups
+(one per linking permutation), the hit is still checked by similarity.
+"""
+
+from qas.sentence import signature, ParseTree
+
+SLOT = "<slot>"
+
+
+def masked_template(doc, masked):
+    """
+    Question template with masked tokens.
+
+    Args:
+        doc (spacy.tokens.Doc): parsed question.
+        masked (set of int): indexes of tokens replaced by the slot
+            (a continuous run of them is a single slot).
+
+    Returns:
+        tuple of str: template parts.
+    """
+    parts = []
+    previous = None
+    for token in ParseTree.filter_punctuation(doc):
+        if token.i in masked:
+            if previous not in masked:
+                parts.append(SLOT)
+        else:
+            parts.append(token.lemma_.lower())
+        previous = token.i
+    return tuple(parts)
+
+
+def permutation_tokens(noun_phrase, permutation):
+    """
+    Indexes of the noun phrase tokens, which the permutation is made of.
+
+    Structural permutations keep spaCy tokens of the noun phrase,
+    synonyms and restored (cached) permutations are plain strings,
+    which are aligned with the noun phrase tokens in order: a string
+    takes the next token with the same text, synonyms (a synonym
+    replaces a single token) take tokens right before the next
+    aligned one.
+
+    >>> from collections import namedtuple
+    >>> Token = namedtuple('Token', ['i', 'text'])
+    >>> tokens = [Token(idx, text) for idx, text
+    ...           in enumerate("the president of France".split(), 2)]
+    >>> NounPhrase = namedtuple('NounPhrase', ['tokens'])
+    >>> sorted(permutation_tokens(NounPhrase(tokens),
+    ...                           NounPhrase([tokens[3]])))
+    [5]
+    >>> sorted(permutation_tokens(NounPhrase(tokens),
+    ...                           NounPhrase(["france"])))
+    [5]
+    >>> sorted(permutation_tokens(NounPhrase(tokens),
+    ...                           NounPhrase(["chief", "of", "France"])))
+    [3, 4, 5]
+    >>> sorted(permutation_tokens(NounPhrase(tokens),
+    ...                           NounPhrase(["president", "of", "Gaul"])))
+    [3, 4, 5]
+
+    Args:
+        noun_phrase (qas.noun_phrase.NounPhrase): linked noun phrase
+            (spaCy tokens).
+        permutation (qas.noun_phrase.NounPhrase): its permutation.
+
+    Returns:
+        set of int: token indexes.
+    """
+    tokens = list(noun_phrase.tokens)
+    # anchors: positions of the kept tokens (or None for synonyms)
+    anchors = []
+    position = 0
+    for token in permutation.tokens:
+        if hasattr(token, 'i'):
+            matching = [idx for idx, original in enumerate(tokens)
+                        if original.i == token.i]
+        else:
+            text = str(token).lower()
+            matching = [idx for idx in range(position, len(tokens))
+                        if tokens[idx].text.lower() == text]
+        if len(matching):
+            position = matching[0] + 1
+            anchors.append(matching[0])
+        else:
+            anchors.append(None)
+    # synonyms take tokens right before the next anchor
+    indexes = set()
+    end = len(tokens)
+    gap = 0
+    for anchor in reversed(anchors):
+        if anchor is None:
+            gap += 1
+            continue
+        indexes.update(tokens[idx].i
+                       for idx in range(max(end - gap, anchor + 1), end))
+        indexes.add(tokens[anchor].i)
+        end = anchor
+        gap = 0
+    indexes.update(tokens[idx].i for idx in range(max(end - gap, 0), end))
+    return indexes
+
+
+def slot_tokens(entities_set, item_id=None):
+    """
+    Masked tokens variants of the entities set, one per permutation
+    (candidate), which linked the item (any item if item_id is None).
+
+    Only tokens of the permutation are masked, the rest of the noun
+    phrase stays in the template ("the president of <slot>").
+
+    Args:
+        entities_set (qas.items.EntitySet): template slot.
+        item_id (str): Wikidata id of the slot item.
+
+    Returns:
+        list of frozenset of int: unique token indexes sets,
+        in the candidates order.
+    """
+    variants = []
+    for entity in entities_set.set:
+        for candidate in entity.candidates:
+            if item_id is not None and item_id not in candidate.item_ids:
+                continue
+            masked = frozenset(permutation_tokens(entity.noun_phrase,
+                                                  candidate.noun_phrase))
+            if len(masked) and masked not in variants:
+                variants.append(masked)
+    return variants
+
+
+def template_hashes(doc, entities_sets, item_id=None):
+    """
+    Hashes of the question templates: every entities set (slot)
+    with tokens of every linking permutation masked.
+
+    >>> from collections import namedtuple
+    >>> from types import SimpleNamespace as Namespace
+    >>> Token = namedtuple('Token', ['i', 'text', 'lemma_', 'pos_'])
+    >>> doc = [Token(idx, text, lemma, pos) for idx, (text, lemma, pos)
+    ...        in enumerate([("Who", "who", "PRON"), ("is", "be", "AUX"),
+    ...                      ("the", "the", "DET"),
+    ...                      ("president", "president", "NOUN"),
+    ...                      ("of", "of", "ADP"), ("France", "France", "PROPN"),
+    ...                      ("?", "?", "PUNCT")])]
+    >>> def candidate(tokens, item_ids):
+    ...     return Namespace(noun_phrase=Namespace(tokens=tokens),
+    ...                      item_ids=item_ids)
+    >>> entity = Namespace(noun_phrase=Namespace(tokens=doc[2:6]),
+    ...                    candidates=[candidate(doc[3:6], ["Q30461"]),
+    ...                                candidate(["France"], ["Q142"])])
+    >>> entities_set = Namespace(set=[entity])
+    >>> template_hashes(doc, [entities_set], "Q142") == [
+    ...     signature("who", "be", "the", "president", "of", SLOT)]
+    True
+    >>> len(template_hashes(doc, [entities_set]))
+    2
+
+    Args:
+        doc (spacy.tokens.Doc): parsed question.
+        entities_sets (list of qas.items.EntitySet): linked entities.
+        item_id (str): Wikidata id of the slot item (None - all
+            linked items).
+
+    Returns:
+        list of int: unique template hashes.
+    """
+    hashes = []
+    for entities_set in entities_sets:
+        for masked in slot_tokens(entities_set, item_id):
+            template_hash = signature(*masked_template(doc, masked))
+            if template_hash not in hashes:
+                hashes.append(template_hash)
+    return hashes
+
+
+class TemplateIndex(object):
+    """
+    Template hash -> record id index.
+
+    Attributes:
+        templates (dict): template hash -> id of the first record
+            with the template.
+    """
+    def __init__(self, templates=None):
+        self.templates = {} if templates is None else templates
+
+    def __len__(self):
+        return len(self.templates)
+
+    def add(self, template_hash, record_id):
+        self.templates.setdefault(template_hash, record_id)
+
+    def get(self, template_hash):
+        return self.templates.get(template_hash)
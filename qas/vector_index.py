@@ -0,0 +1,235 @@
+"""
+Reference questions vector index.
+
+Normalized document vectors of stored questions are kept in a float32
+matrix file (memory-mapped), row number is the knowledge record id:
+
+    header (magic, dimension) + rows * dimension float32 values
+
+Cosine similarity with all stored questions is then a single
+matrix-vector product. The approximate mode (random hyperplanes LSH)
+scores only the rows sharing a hash bucket with the query.
+"""
+
+import os
+import struct
+
+from qas.lazy import numpy
+
+MAGIC = b'QASV'
+HEADER = struct.Struct('=4sI')
+TOP_K = 5
+LSH_TABLES = 8
+LSH_BITS = 12
+LSH_SEED = 1
+
+
+class InvalidVectorIndex(Exception):
+    pass
+
+
+def normalize(vector):
+    """
+    Unit length float32 vector (zero vector stays zero).
+    """
+    vector = numpy.asarray(vector, dtype=numpy.float32)
+    norm = numpy.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+class VectorIndex(object):
+    """
+    Memory-mapped matrix of normalized question vectors.
+
+    Attributes:
+        filename (str): matrix file.
+        dimension (int): vectors length.
+        approximate (bool): use LSH buckets instead of the full scan.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'questions.vectors')
+    >>> index = VectorIndex(filename, 3, approximate=True)
+    >>> [index.add(vector) for vector in ([1, 0, 0], [0, 1, 0], [1, 1, 0])]
+    [0, 1, 2]
+    >>> [row for _, row in index.top_k(numpy.array([1, 0.1, 0]), k=2)]
+    [0, 2]
+    >>> loaded = VectorIndex(filename, 3, approximate=True)
+    >>> loaded.buckets == index.buckets
+    True
+    """
+    def __init__(self, filename, dimension, approximate=False):
+        if dimension <= 0:
+            raise ValueError("vectors dimension must be positive")
+        self.filename = filename
+        self.dimension = dimension
+        self.approximate = approximate
+        self.matrix = None
+        self.planes = None
+        self.buckets = None
+        if os.path.exists(filename):
+            with open(filename, 'rb') as index_file:
+                magic, stored_dimension = HEADER.unpack(
+                    index_file.read(HEADER.size))
+            if magic != MAGIC:
+                raise InvalidVectorIndex(filename)
+            if stored_dimension != dimension:
+                # other vectors model, index is rebuilt
+                os.remove(filename)
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as index_file:
+                index_file.write(HEADER.pack(MAGIC, dimension))
+        self.load()
+
+    def __len__(self):
+        return 0 if self.matrix is None else self.matrix.shape[0]
+
+    def load(self):
+        self.map_rows()
+        if self.approximate:
+            self.hash_rows()
+
+    def map_rows(self):
+        rows = (os.path.getsize(self.filename) - HEADER.size) // \
+            (self.dimension * 4)
+        if rows == 0:
+            self.matrix = None
+        else:
+            self.matrix = numpy.memmap(self.filename,
+                                       dtype=numpy.float32,
+                                       mode='r',
+                                       offset=HEADER.size,
+                                       shape=(rows, self.dimension))
+
+    def add(self, vector):
+        """
+        Append vector of the next record (only the new row is hashed).
+
+        Returns:
+            int: row (record id).
+        """
+        row = len(self)
+        vector = normalize(vector)
+        with open(self.filename, 'ab') as index_file:
+            index_file.write(vector.tobytes())
+        self.map_rows()
+        if self.approximate:
+            self.hash_row(row, self.codes(vector[numpy.newaxis])[0])
+        return row
+
+    def truncate(self, rows):
+        """
+        Keep only first rows (drop vectors of unknown records).
+        """
+        if rows < len(self):
+            self.matrix = None
+            with open(self.filename, 'r+b') as index_file:
+                index_file.truncate(HEADER.size + rows * self.dimension * 4)
+            self.load()
+
+    def codes(self, vectors):
+        # one LSH code per table: signs of the hyperplanes projections
+        bits = (numpy.dot(vectors, self.planes.T) > 0).reshape(
+            len(vectors), LSH_TABLES, LSH_BITS)
+        return numpy.dot(bits, 1 << numpy.arange(LSH_BITS))
+
+    def hash_rows(self):
+        if self.planes is None:
+            random = numpy.random.RandomState(LSH_SEED)
+            self.planes = random.standard_normal(
+                (LSH_TABLES * LSH_BITS, self.dimension)).astype(numpy.float32)
+        self.buckets = [{} for _ in range(LSH_TABLES)]
+        if self.matrix is None:
+            return
+        for row, codes in enumerate(self.codes(self.matrix)):
+            self.hash_row(row, codes)
+
+    def hash_row(self, row, codes):
+        for table, code in enumerate(codes):
+            self.buckets[table].setdefault(int(code), []).append(row)
+
+    def candidates(self, vector):
+        rows = set()
+        for table, code in enumerate(self.codes(vector[numpy.newaxis])[0]):
+            rows.update(self.buckets[table].get(int(code), []))
+        return sorted(rows)
+
+    def score(self, vector, rows):
+        """
+        Similarities of the given stored questions only.
+
+        Args:
+            vector (numpy.ndarray): question vector.
+            rows (list of int): record ids.
+
+        Returns:
+            list: (cosine similarity, record id) pairs, the best first.
+        """
+        rows = [row for row in rows if row < len(self)]
+        if len(rows) == 0:
+            return []
+        scores = numpy.dot(self.matrix[numpy.array(rows)], normalize(vector))
+        matches = [(float(score), row, ) for score, row in zip(scores, rows)]
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return matches
+
+    def top_k(self, vector, k=TOP_K, include=()):
+        """
+        Stored questions with the most similar vectors.
+
+        Args:
+            vector (numpy.ndarray): question vector.
+            k (int): maximal number of records.
+            include (iterable of int): rows scored in any case
+                (approximate mode, all rows are scored otherwise).
+
+        Returns:
+            list: (cosine similarity, record id) pairs, the best first.
+        """
+        if self.matrix is None:
+            return []
+        vector = normalize(vector)
+        if self.approximate:
+            rows = sorted(set(self.candidates(vector)) | set(include))
+            if len(rows) == 0:
+                return []
+            rows = numpy.array(rows)
+            scores = numpy.dot(self.matrix[rows], vector)
+        else:
+            rows = None
+            scores = numpy.dot(self.matrix, vector)
+        k = min(k, len(scores))
+        best = numpy.argpartition(-scores, k - 1)[:k]
+        best = best[numpy.argsort(-scores[best], kind='mergesort')]
+        return [(float(scores[idx]),
+                 int(idx if rows is None else rows[idx]), )
+                for idx in best]
+
+    def top_k_many(self, vectors, k=TOP_K):
+        """
+        Stored questions with the most similar vectors for several
+        questions at once (a single matrix product, exact mode).
+
+        Args:
+            vectors (list of numpy.ndarray): questions vectors.
+            k (int): maximal number of records per question.
+
+        Returns:
+            list: top_k result for every vector.
+        """
+        if self.matrix is None or len(vectors) == 0:
+            return [[] for _ in vectors]
+        if self.approximate:
+            return [self.top_k(vector, k=k) for vector in vectors]
+        queries = numpy.array([normalize(vector) for vector in vectors])
+        scores = numpy.dot(self.matrix, queries.T)
+        k = min(k, scores.shape[0])
+        results = []
+        for column in range(scores.shape[1]):
+            column_scores = scores[:, column]
+            best = numpy.argpartition(-column_scores, k - 1)[:k]
+            best = best[numpy.argsort(-column_scores[best], kind='mergesort')]
+            results.append([(float(column_scores[idx]), int(idx), )
+                            for idx in best])
+        return results
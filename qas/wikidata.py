@@ -6,15 +6,8 @@ Python 3.6.1 with grequests causes an error.
 import json
 import time
 
-
-from gevent import monkey
-def stub(*args, **kwargs):  # pylint: disable=unused-argument
-    pass
-monkey.patch_all = stub
-monkey.patch_ssl()
-
-import grequests
-import requests
+# gevent SSL patch is applied on the first use of requests
+from qas.lazy import grequests, requests
 
 
 MATCHING_TIMEOUT = 10
@@ -33,9 +26,9 @@ class NoSPARQLResponse(Exception):
     pass
 
 
-def get_json(url, params):
+def get_json(url, params, timeout=DEFAULT_SPARQL_TIMEOUT):
     try:
-        response = requests.get(url, params=params, timeout=10)
+        response = requests.get(url, params=params, timeout=timeout)
     except requests.exceptions.ReadTimeout:
         # print("10 seconds timeout")
         raise NoSPARQLResponse()
@@ -52,15 +45,31 @@ class WikidataItemsNotFound(Exception):
 
 
 CACHE = {
-    "wikidata_search_by_label": {}
+    "wikidata_search_by_label": {},
+    "wikidata_types": {},
+    "sparql": None  # query -> response, disabled by default
 }
 
 
+def use_sparql_cache(cache):
+    """
+    Cache SPARQL responses (any dict-like object, e.g. shared by
+    multiprocessing.Manager between processes, or None to disable).
+    """
+    CACHE['sparql'] = cache
+
+
 class Wikidata():
 
     @staticmethod
-    def search_by_label_parallel(queries, entity_type="item"):
-
+    def search_by_label_parallel(queries, entity_type="item", failed=None):
+        """
+        Search several labels at once (None for queries without results).
+
+        Args:
+            failed (set): queries, which failed (timeout, invalid
+                response), are added to the set.
+        """
         # no queries => empty response
         if len(queries) == 0:
             return {}
@@ -107,12 +116,16 @@ class Wikidata():
             # requests exception skip
             if response is None:
                 result[query] = None
+                if failed is not None:
+                    failed.add(query)
                 continue
             try:
                 data = response.json()
             except json.decoder.JSONDecodeError:
                 # JSON decoding skip
                 result[query] = None
+                if failed is not None:
+                    failed.add(query)
             else:
                 if len(data['search']) == 0:
                     # zero results skip
@@ -146,7 +159,37 @@ class Wikidata():
         return response['search']
 
     @classmethod
-    def sparql_parallel(cls, queries, timeout=None):
+    def sparql_parallel(cls, queries, timeout=None, failed=None):
+        """
+        Several SPARQL queries at once (None for failed queries).
+
+        Args:
+            failed (set): queries, which failed (timeout, invalid
+                response), are added to the set.
+        """
+        cache = CACHE['sparql']
+        if cache is None:
+            return cls.request_sparql_parallel(queries, timeout=timeout,
+                                               failed=failed)
+        result = {}
+        for query in queries:
+            response = cache.get(query)
+            if response is not None:
+                result[query] = response
+        missing = [query for query in queries if query not in result]
+        if len(missing) == 0:
+            return result, timeout
+        responses, timeout = cls.request_sparql_parallel(missing,
+                                                         timeout=timeout,
+                                                         failed=failed)
+        for query, response in responses.items():
+            if response is not None:
+                cache[query] = response
+        result.update(responses)
+        return result, timeout
+
+    @classmethod
+    def request_sparql_parallel(cls, queries, timeout=None, failed=None):
         print(len(queries), "parallel sparql queries")
         # no queries => empty response
         if len(queries) == 0:
@@ -188,20 +231,24 @@ class Wikidata():
             time.sleep(TOO_MANY_REQUESTS_TIMEOUT)
             print("= too many requests timeout ({}s) =".format(
                 TOO_MANY_REQUESTS_TIMEOUT))
-            cls.sparql_parallel(queries,
-                                timeout=(timeout * TIMEOUT_MULTIPLIER))
+            cls.request_sparql_parallel(queries,
+                                        timeout=(timeout * TIMEOUT_MULTIPLIER))
 
         # parse JSON, extend dictionary
         for query, response in zip(queries, responses):
             # requests exception skip
             if response is None:
                 result[query] = None
+                if failed is not None:
+                    failed.add(query)
                 continue
             try:
                 data = response.json()
             except json.decoder.JSONDecodeError:
                 # JSON decoding skip
                 result[query] = None
+                if failed is not None:
+                    failed.add(query)
             else:
                 result[query] = data
 
@@ -217,16 +264,64 @@ class Wikidata():
         return result, avg_elapsed_time
 
     @staticmethod
-    def sparql(query):
+    def sparql(query, timeout=DEFAULT_SPARQL_TIMEOUT):
+        cache = CACHE['sparql']
+        if cache is not None:
+            response = cache.get(query)
+            if response is not None:
+                return response
         url = "https://query.wikidata.org/sparql"
         params = {
             "query": query,
             "format": "json"
         }
-        response = get_json(url, params)
+        response = get_json(url, params, timeout=timeout)
+        if cache is not None:
+            cache[query] = response
         return response
         # return response['entities']
 
+    @classmethod
+    def get_types(cls, ids, timeout=DEFAULT_SPARQL_TIMEOUT):
+        """
+        Types (instance of) of items with a single SPARQL query.
+
+        Args:
+            ids (list of str): Wikidata item ids.
+
+        Returns:
+            dict: item id -> list of type item ids.
+
+        Raises:
+            NoSPARQLResponse: query failed or timed out.
+        """
+        result = {}
+        missing = []
+        for item_id in ids:
+            if item_id in CACHE['wikidata_types']:
+                result[item_id] = CACHE['wikidata_types'][item_id]
+            elif item_id.startswith('Q'):
+                missing.append(item_id)
+        if len(missing):
+            query = """
+            SELECT ?item ?type WHERE {{
+                VALUES ?item {{ {} }}
+                ?item <http://www.wikidata.org/prop/direct/P31> ?type .
+            }}
+            """.format(" ".join(
+                "<http://www.wikidata.org/entity/{}>".format(item_id)
+                for item_id in missing))
+            response = cls.sparql(query, timeout=timeout)
+            for item_id in missing:
+                result[item_id] = []
+            for binding in response['results']['bindings']:
+                item_id = binding['item']['value'].split("/")[-1]
+                type_id = binding['type']['value'].split("/")[-1]
+                result[item_id].append(type_id)
+            for item_id in missing:
+                CACHE['wikidata_types'][item_id] = result[item_id]
+        return result
+
     # parallel get_items ??
     @classmethod
     def get_items(cls, ids, entity_type="item"):
@@ -28,6 +28,16 @@ def watchdog(target, args, queue):
 
 
 QAS = QASystem()
+# warm up in the parent, answering processes are forked ready
+QAS.warm_up()
+QAS.wait_ready()
+# forked processes open their own connection
+QAS.store.close()
+
+
+def answering(question):
+    QAS.reopen()
+    QAS.answer(question)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
@@ -46,7 +56,7 @@ def answer(message):
     QAS.add_output_queue(queue)
 
     watchdog_proc = multiprocessing.Process(target=watchdog,
-                                            args=(QAS.answering,
+                                            args=(answering,
                                                   (message["question"], ),
                                                   queue, ))
     watchdog_proc.start()